@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Benchmark of the ptex2tex conversion stages.
+
+For each document size, a synthetic document is generated by corpus.py
+and converted stage by stage (preprocessor, inline_tt, include_file,
+include_command, convert). Each stage is run several times on the
+output of the previous stage, and the best time is reported together
+with the throughput in MB/s of input text to the stage.
+
+Usage: python bench.py [options]
+(run python bench.py -h for the options)
+"""
+import sys, os, time, shutil, tempfile
+from cStringIO import StringIO
+from optparse import OptionParser
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(root, 'lib'))
+from ptex2tex import _Ptex2tex
+import corpus
+
+stages = ('preprocessor', 'inline_tt', 'include_file', 'include_command',
+          'convert')
+default_sizes = '10K,100K,1M,10M,50M'
+
+def parse_size(size):
+    """Convert sizes like 500, 10K and 2M to no of bytes."""
+    factors = {'K': 1000, 'M': 1000**2}
+    if size[-1].upper() in factors:
+        return int(float(size[:-1])*factors[size[-1].upper()])
+    return int(size)
+
+def time_stage(method, text, repeat):
+    """Run method(text) repeat times (or method() for the preprocessor
+    stage, which reads the file). Return the best time and the output."""
+    best = None
+    for i in range(repeat):
+        stdout = sys.stdout
+        sys.stdout = StringIO()  # the stages print progress messages
+        try:
+            t0 = time.time()
+            if text is None:
+                output = method()
+            else:
+                output = method(text)
+            t = time.time() - t0
+        finally:
+            sys.stdout = stdout
+        if best is None or t < best:
+            best = t
+    return best, output
+
+def bench(filename, repeat=3, argv=()):
+    """Time the stages on the .p.tex file filename. Return a list of
+    (stage, input size in bytes, best time) tuples."""
+    dirname, basename = os.path.split(filename)
+    cwd = os.getcwd()
+    home = os.environ.get('HOME')
+    os.chdir(dirname)  # includes and config files are relative to the file
+    # let the corpus directory be the home directory such that the user's
+    # ~/.ptex2tex.cfg is neither read nor created:
+    os.environ['HOME'] = dirname
+    try:
+        p = _Ptex2tex(['ptex2tex'] + list(argv) + [basename])
+        results = []
+        text = None
+        for stage in stages:
+            size = os.path.getsize(basename) if text is None else len(text)
+            t, text = time_stage(getattr(p, stage), text, repeat)
+            results.append((stage, size, t))
+    finally:
+        os.chdir(cwd)
+        if home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = home
+    return results
+
+def report(label, results):
+    print '%s:' % label
+    total = 0
+    for stage, size, t in results:
+        total += t
+        rate = size/1E6/t if t > 0 else float('inf')
+        print '  %-16s %10d bytes %9.4f s %9.2f MB/s' % (stage, size, t, rate)
+    size = results[0][1]
+    rate = size/1E6/total if total > 0 else float('inf')
+    print '  %-16s %10d bytes %9.4f s %9.2f MB/s' % ('total', size, total, rate)
+
+def options():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=default_sizes,
+                      help='comma-separated document sizes (default: %s)'
+                      % default_sizes)
+    parser.add_option('--repeat', type='int', default=3,
+                      help='no of runs of each stage, the best is reported')
+    parser.add_option('--envirs', type='int', default=5,
+                      help='number of different environments')
+    parser.add_option('--code-density', type='int', default=3,
+                      help=r'number of \code{} commands per paragraph')
+    parser.add_option('--includes', type='float', default=0.1,
+                      help='fraction of the blocks that are @@@CODE includes')
+    parser.add_option('--commands', type='int', default=0,
+                      help='number of @@@CMD lines')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--keep', action='store_true',
+                      help='keep the generated documents')
+    return parser
+
+def main():
+    opts, args = options().parse_args()
+    for size in opts.sizes.split(','):
+        dirname = tempfile.mkdtemp(prefix='ptex2tex-bench-')
+        try:
+            filename = corpus.generate(
+                dirname, parse_size(size), opts.envirs, opts.code_density,
+                opts.includes, opts.commands, opts.seed)
+            report('%s (%s)' % (size, filename), bench(filename, opts.repeat))
+        finally:
+            if not opts.keep:
+                shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    main()
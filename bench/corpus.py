@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Generator of synthetic .p.tex documents for benchmarking ptex2tex.
+
+The documents consist of paragraphs of text with inline \\code{} and
+\\emp{} commands, and of environment blocks with the demo code from
+bin/testconfig.py. Parts of the blocks can be @@@CODE includes from a
+generated Python module, and @@@CMD lines can be added. The environment
+names are taken from the [names] section of the default config file
+(lib/ptex2tex/ptex2tex.cfg), which is copied to the corpus directory.
+
+Usage: python corpus.py [options] dirname
+(run python corpus.py -h for the options)
+"""
+import sys, os, random, shutil
+from optparse import OptionParser
+import ConfigParser
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(root, 'bin'))
+from testconfig import snippet
+
+default_cfgfile = os.path.join(root, 'lib', 'ptex2tex', 'ptex2tex.cfg')
+
+words = ('the', 'function', 'returns', 'a', 'value', 'of', 'array',
+         'loop', 'over', 'all', 'elements', 'and', 'compute', 'sum',
+         'which', 'is', 'printed', 'in', 'terminal', 'window')
+inline_codes = ('x', 'sum(a)', 'a[i]', 'f(x, y)', 'numpy.zeros', 'i!=j',
+                'self.value', 'x_1', 'import sys', '"%s" % name')
+
+def environment_names(cfgfile=default_cfgfile):
+    """Return a dict with the names in the [names] section of the config
+    file as keys and the environment types as values."""
+    config = ConfigParser.SafeConfigParser()
+    config.read(cfgfile)
+    return dict(config.items('names'))
+
+def paragraph(code_density):
+    """Return a paragraph of 40-80 words with code_density \\code{}
+    commands (and one \\emp{} command)."""
+    text = [random.choice(words) for i in range(random.randint(40, 80))]
+    for i in range(code_density):
+        text.insert(random.randint(0, len(text)),
+                    r'\code{%s}' % random.choice(inline_codes))
+    text.insert(random.randint(0, len(text)), r'\emp{%s}' % words[0])
+    lines = []
+    for i in range(0, len(text), 10):
+        lines.append(' '.join(text[i:i+10]))
+    return '\n'.join(lines) + '.\n\n'
+
+def block(name, envir_type):
+    """Return the demo code from testconfig for the environment name."""
+    code = snippet(envir_type)
+    code = code.replace(r'\bn%d', '\\b' + name).replace(r'\en%d', '\\e' + name)
+    return code % name
+
+def module(nfunctions):
+    """Return the text of a Python module with nfunctions functions
+    to be included by @@@CODE statements."""
+    functions = []
+    for i in range(nfunctions):
+        functions.append('''\
+def f%d(x, y):
+    """Compute something with x and y."""
+    s = 0
+    for i in range(len(x)):
+        s += x[i]*y[i] + %d
+    return s
+''' % (i, i))
+    return '\n'.join(functions)
+
+def generate(dirname, size=100000, nenvirs=5, code_density=3,
+             include_fraction=0.1, ncommands=0, seed=1,
+             cfgfile=default_cfgfile):
+    """
+    Generate the document corpus.p.tex of approximately size bytes in
+    the directory dirname, together with the config file .ptex2tex.cfg
+    and the module corpus_code.py for @@@CODE includes.
+
+    nenvirs: number of different environments used in the blocks.
+    code_density: number of \\code{} commands per paragraph.
+    include_fraction: fraction of the blocks that are @@@CODE includes.
+    ncommands: number of @@@CMD lines.
+    Return the name of the .p.tex file.
+    """
+    random.seed(seed)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    shutil.copy(cfgfile, os.path.join(dirname, '.ptex2tex.cfg'))
+    nfunctions = 50
+    open(os.path.join(dirname, 'corpus_code.py'), 'w').write(
+        module(nfunctions))
+
+    names = environment_names(cfgfile)
+    used = random.sample(sorted(names), min(nenvirs, len(names)))
+    parts = ['\\section{Synthetic ptex2tex corpus}\n\n']
+    length = len(parts[0])
+    while length < size:
+        parts.append(paragraph(code_density))
+        if random.random() < include_fraction:
+            i = random.randint(0, nfunctions-2)
+            parts.append('@@@CODE corpus_code.py def f%d(@def f%d(\n'
+                         % (i, i+1))
+        else:
+            name = random.choice(used)
+            parts.append(block(name, names[name]) + '\n')
+        length += len(parts[-2]) + len(parts[-1])
+    # spread the @@@CMD lines over the document:
+    for i in range(ncommands):
+        parts.insert(random.randint(1, len(parts)),
+                     '@@@CMD echo result of command no %d\n' % i)
+    filename = os.path.join(dirname, 'corpus.p.tex')
+    open(filename, 'w').write(''.join(parts))
+    return filename
+
+def options():
+    parser = OptionParser(usage='%prog [options] dirname')
+    parser.add_option('--size', type='int', default=100000,
+                      help='approximate size of the document in bytes')
+    parser.add_option('--envirs', type='int', default=5,
+                      help='number of different environments')
+    parser.add_option('--code-density', type='int', default=3,
+                      help=r'number of \code{} commands per paragraph')
+    parser.add_option('--includes', type='float', default=0.1,
+                      help='fraction of the blocks that are @@@CODE includes')
+    parser.add_option('--commands', type='int', default=0,
+                      help='number of @@@CMD lines')
+    parser.add_option('--seed', type='int', default=1)
+    return parser
+
+if __name__ == '__main__':
+    parser = options()
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('missing directory name')
+    print generate(args[0], opts.size, opts.envirs, opts.code_density,
+                   opts.includes, opts.commands, opts.seed)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Check of the start-up cost of ptex2tex.
+
+Importing the ptex2tex package should only load the modules that every
+conversion needs; the modules used by some of the stages (optparse,
+ConfigParser, shutil, subprocess, ...) are imported by the stages
+themselves. This script imports ptex2tex in a fresh interpreter a
+number of times, reports the best import time and the modules loaded
+by the import, and exits with status 1 if a module outside the allowed
+set is loaded. The import time depends on the machine, so it is only
+checked if a budget is given with --budget.
+
+Usage: python startup.py [--budget MS] [--repeat N]
+"""
+import sys, os, subprocess
+from optparse import OptionParser
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# modules that may be loaded by "import ptex2tex":
+allowed = set(['ptex2tex', 'ptex2tex.envs', 'ptex2tex.cache',
+               'ptex2tex.errors', 'cStringIO', 'cPickle', 'time'])
+
+measure = """\
+import sys, time
+before = set(sys.modules)
+t0 = time.time()
+import ptex2tex
+t = time.time() - t0
+print t
+print ' '.join(sorted([m for m in set(sys.modules) - before
+                       if sys.modules[m] is not None]))
+"""
+
+def import_ptex2tex():
+    """Import ptex2tex in a new interpreter. Return the import time
+    and the list of modules loaded by the import."""
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.path.join(root, 'lib') + os.pathsep + \
+                        env.get('PYTHONPATH', '')
+    output = subprocess.Popen([sys.executable, '-c', measure], env=env,
+                              stdout=subprocess.PIPE).communicate()[0]
+    t, modules = output.split('\n')[:2]
+    return float(t), modules.split()
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--budget', type='float', default=None,
+                      help='maximum import time in ms (default: no limit)')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='no of imports, the best time is reported')
+    opts, args = parser.parse_args()
+
+    best = None
+    for i in range(opts.repeat):
+        t, modules = import_ptex2tex()
+        if best is None or t < best:
+            best = t
+    if opts.budget is None:
+        print 'import ptex2tex: %.1f ms' % (best*1000)
+    else:
+        print 'import ptex2tex: %.1f ms (budget %.1f ms)' % \
+              (best*1000, opts.budget)
+    print 'modules loaded: %s' % ' '.join(modules)
+    failed = False
+    extra = [m for m in modules if m not in allowed]
+    if extra:
+        print '*** modules that should be imported lazily: %s' % \
+              ' '.join(extra)
+        failed = True
+    if opts.budget is not None and best*1000 > opts.budget:
+        print '*** import time exceeds the budget'
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -350,55 +350,65 @@ i= 6:  2.916777431  8.182726252
 
 }
 
-f = open('.ptex2tex.cfg')
-envir_types = []
-for line in f:
-    if line.startswith('['):
-        envir_type = line.strip()[1:-1]
-        if envir_type not in ('preprocess', 'inline_code', 'names'):
-            envir_types.append(envir_type)
-f.close()
-names = open('tmp_names', 'w')
-index = 1
-for e in envir_types:
-    names.write('n%d = %s\n' % (index, e))
-    index += 1
-names.close()
-print """
-A [names] section is written to the file tmp_names and should
-be appended to the .ptex2tex.cfg file in the current directory.
-"""
-
-latex = open('tmp_latex', 'w')
-for i in range(1, index):
-    envir = envir_types[i-1]
+def snippet(envir):
+    """Return the demo code (with %s for the environment name and
+    %d for the number in the \\bn%d/\\en%d markers) for an
+    environment type."""
     if envir in ('Warnings', 'Tip', 'Note'):
-        code = snippets['box']
+        return snippets['box']
     elif envir in ('CodeRule', 'CodeTerminal'):
-        code = snippets['smallpy']
-    elif envir.startswith('Minted_'):
-        code = snippets[envir[7:]]
+        return snippets['smallpy']
+    elif envir.startswith('Minted_') and envir[7:] in snippets:
+        return snippets[envir[7:]]
     elif envir.endswith('_ANS'):
-        code = snippets[envir[:-4]]
+        return snippets[envir[:-4]]
     elif envir.endswith('_ANSt'):
-        code = snippets[envir[:-5]]
+        return snippets[envir[:-5]]
     elif envir.endswith('Tiago'):
-        code = snippets[envir[:-5]]
+        return snippets[envir[:-5]]
     else:
-        code = snippets['Python']
-
-    try:
-        code = code % (envir, i, i)
-        latex.write(code)
-    except ValueError, e:
-        print code
-        print e
-        sys.exit(1)
-
-latex.close()
-print """\
+        return snippets['Python']
+
+def main():
+    f = open('.ptex2tex.cfg')
+    envir_types = []
+    for line in f:
+        if line.startswith('['):
+            envir_type = line.strip()[1:-1]
+            if envir_type not in ('preprocess', 'inline_code', 'names'):
+                envir_types.append(envir_type)
+    f.close()
+    names = open('tmp_names', 'w')
+    index = 1
+    for e in envir_types:
+        names.write('n%d = %s\n' % (index, e))
+        index += 1
+    names.close()
+    print """
+A [names] section is written to the file tmp_names and should
+be appended to the .ptex2tex.cfg file in the current directory.
+"""
+
+    latex = open('tmp_latex', 'w')
+    for i in range(1, index):
+        envir = envir_types[i-1]
+        code = snippet(envir)
+
+        try:
+            code = code % (envir, i, i)
+            latex.write(code)
+        except ValueError, e:
+            print code
+            print e
+            sys.exit(1)
+
+    latex.close()
+    print """\
 A LaTeX demo code of all environments defined in .ptex2tex.cfg
 is written to the file tmp_latex and should be included
 in some LaTeX document (usually the doc.p.tex documentation
 of ptex2tex).
 """
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 #!/bin/sh
-files="*.aux *.dvi *.log *.out *.tmp* tmp* doc.tex *.ps doc.pdf"
+files="*.aux *.dvi *.log *.out *.tmp* tmp* doc.tex *.ps doc.pdf .ptex2tex-cache"
 echo "removing the following files:"
 /bin/ls $files 2> /dev/null
 rm -rf $files
\ No newline at end of file
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-__all__ = ['__doc__']
+__all__ = ['__doc__', 'convert', 'Ptex2texError']
 
-import sys, os, re, shutil, string, glob, commands
-from optparse import OptionParser
+# Only the modules needed by every conversion are imported here; the
+# modules used by some of the stages are imported where they are needed,
+# such that the start-up time of ptex2tex is small:
+import sys, os, re, time
 import ptex2tex.envs as envs
+import ptex2tex.cache as cache
+from ptex2tex.errors import Ptex2texError
 
 __version__ = "0.5"
 
@@ -13,6 +17,12 @@ code_statement = "@@@CODE"
 data_statement = "@@@DATA"
 cmd_statement  = "@@@CMD"
 
+# \emp{, \code{ and \protect\code{ constructions handled by inline_tt:
+inline_pattern = re.compile(r'\\emp\{|(\\protect\s*)?\\code\{')
+emp_end_pattern = re.compile(r'[}\n]')
+# characters that can follow the closing } of \code{...}:
+code_endings = ' \n,.;:?!)"\'-'
+
 def doc():
     return """
 Main class for converting from the ptex to the tex format.
@@ -55,6 +65,20 @@ Examples:
 @@@CODE IntegrateSine.py for i in@sys.exit(1)
     -> includes everything from the first instance of the string 'for i in'
        _up to_ the first instance of 'sys.exit(1)' _after_ 'for i in'.
+@@@CODE IntegrateSine.py head=10
+    -> includes the first 10 lines (tail=10: the last 10 lines)
+@@@CODE IntegrateSine.py lines=5-12
+    -> includes line 5 to line 12 (both included)
+@@@CODE IntegrateSine.py symbol:Integrator.integrate
+    -> includes the method integrate in class Integrator (with its
+       decorators), found from an index of the def and class statements
+@@@CODE IntegrateSine.py re:^def\s+integrate@^def
+    -> the expressions are regular expressions (for all statements with
+       --regex), matched one line at a time (^ is the start of a line)
+
+The file is memory-mapped, so for head=N, lines=A-B and search
+expressions near the top of a large file, only the beginning of the
+file is read, and tail=N only reads the end of the file.
 
 data_statement:
 Exactly the same as code_statement, but a different environment is
@@ -76,6 +100,12 @@ to be printed as
 python SineEval.py
 In order to avoid this, the argument after '#' must be set to 2.
 
+The output of a command (stdout and stderr) is collected in a temporary
+file. A command is killed if it runs longer than --cmd-timeout seconds,
+or if all commands together run longer than --cmd-total-timeout seconds
+(the conversion then fails), and the output is cut after
+--cmd-max-output bytes (16 MB by default, 0 for no limit).
+
 Examples:
 @@@CMD python code/SineEval.py 'sqrt(2)' 5 # 1
 @@@CMD python code/SineEval.py 'sqrt(2)' 5 #1
@@ -91,40 +121,461 @@ Examples:
 For now, the environment 'Verb' is used.
 """
 
+# preprocessor statements (e.g. '% #ifdef VAR'):
+preprocess_statement_pattern = re.compile(r'^\s*%\s*#', re.MULTILINE)
+# '% #include FILE' statements:
+preprocess_include_pattern = re.compile(
+    r'^\s*%\s*#\s*include\s+["\']?([^"\'\s]+)', re.MULTILINE)
+# statements that start and end a preprocessor #if block:
+preprocess_if_pattern = re.compile(r'\s*%\s*#\s*if(n?def)?\b')
+preprocess_endif_pattern = re.compile(r'\s*%\s*#\s*endif\b')
+
+# @@@CODE/@@@DATA file head=N, tail=N or lines=A-B (first/last N lines,
+# line A to B):
+line_region_pattern = re.compile(r'^(?:(head|tail)=(\d+)|lines=(\d+)-(\d+))$')
+# @@@CODE file.py symbol:NAME (a function, class or method, e.g. A.f):
+symbol_pattern = re.compile(r'^symbol:\s*([A-Za-z_][\w.]*)$')
+# start/stop expressions that are regular expressions (--regex or re:),
+# compiled once per run, and the default time limit of a search in
+# seconds (--regex-timeout):
+_regexes = {}
+regex_timeout = 5.0
+
+# minimum size of the chunks converted one by one in streaming mode:
+stream_chunk_size = 65536
+
+# command-line options that take the next argument as value:
+value_options = ('-I', '-j', '--profile', '--pygments-style', '--cmd-timeout',
+                 '--cmd-total-timeout', '--cmd-max-output', '--regex-timeout')
+
+# default limit of the output of one @@@CMD command (--cmd-max-output):
+cmd_max_output = 16*1024*1024
+
+def split_argv(argv):
+    """Split the command-line arguments argv (without the program name)
+    into a list of options (with their values) and a list of files."""
+    options = []
+    files = []
+    i = 0
+    while i < len(argv):
+        if argv[i] in value_options and i+1 < len(argv):
+            options.extend(argv[i:i+2])
+            i += 2
+        elif argv[i].startswith('-') and argv[i] != '-':
+            options.append(argv[i])
+            i += 1
+        else:
+            files.append(argv[i])
+            i += 1
+    return options, files
+
+def option_value(argv, option, default=None):
+    """Return the value of the (last) option given as 'option value'
+    in argv (default if the option is not given)."""
+    value = default
+    for i in range(len(argv)-1):
+        if argv[i] == option:
+            value = argv[i+1]
+    return value
+
+def number_option(argv, option, convert=float, default=None):
+    """Return the number given by 'option value' in argv, converted by
+    convert (default if the option is not given)."""
+    value = option_value(argv, option)
+    if value is None:
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        raise Ptex2texError('%s requires a number, not %s' % (option, value), 1)
+
+def compile_regex(expression):
+    """Return the compiled regular expression (each expression is
+    compiled once per run)."""
+    if expression not in _regexes:
+        try:
+            _regexes[expression] = re.compile(expression, re.MULTILINE)
+        except re.error, e:
+            raise Ptex2texError('invalid regular expression "%s": %s' %
+                                (expression, e), 1)
+    return _regexes[expression]
+
+def time_limited(function, args, limit):
+    """Return function(*args), computed in a child process that is
+    killed after limit seconds (then None is returned). The result is
+    sent back pickled. The re module cannot be interrupted while it
+    matches, so this is the only way to stop a regular expression with
+    catastrophic backtracking. Without os.fork (Windows), function is
+    called directly and there is no limit."""
+    if limit is None or not hasattr(os, 'fork'):
+        return function(*args)
+    import cPickle as pickle, select
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            data = pickle.dumps(function(*args), pickle.HIGHEST_PROTOCOL)
+            while data:
+                data = data[os.write(w, data):]
+        finally:
+            os._exit(0)
+    os.close(w)
+    deadline = time.time() + limit
+    chunks = []
+    try:
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                os.kill(pid, 9)
+                return None
+            if select.select([r], [], [], left)[0]:
+                data = os.read(r, 65536)
+                if not data:
+                    break
+                chunks.append(data)
+    finally:
+        os.close(r)
+        os.waitpid(pid, 0)
+    if not chunks:
+        return function(*args)  # failed in the child, raise the error here
+    return pickle.loads(''.join(chunks))
+
+def write_if_changed(filename, text):
+    """Write text to filename, unless the file already has this
+    content (then the file and its modification time are not touched).
+    The text is written to a temporary file in the same directory, which
+    is renamed to filename, so filename is never partially written.
+    Return True if the file was written."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        stat = None
+    if stat is not None and stat.st_size == len(text):
+        f = open(filename, 'rb')
+        unchanged = f.read() == text
+        f.close()
+        if unchanged:
+            return False
+    import tempfile
+    dirname, basename = os.path.split(filename)
+    fd, tmpname = tempfile.mkstemp(dir=dirname or os.curdir,
+                                   prefix='.' + basename, suffix='.tmp')
+    try:
+        f = os.fdopen(fd, 'wb')
+        f.write(text)
+        f.close()
+        # same permissions as the old file, or as a file made by open:
+        if stat is not None:
+            mode = stat.st_mode & 07777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(tmpname, mode)
+        os.rename(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    return True
+
+def jobs(argv):
+    """Return the number of jobs given by -j N in argv (default: the
+    number of cores)."""
+    n = number_option(argv, '-j', int)
+    if n is None:
+        try:
+            import multiprocessing
+            n = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            n = 1
+    return n
+
+
+class _Messages:
+    """File-like object for the progress messages of a conversion
+    (print >>self.out). The messages are written to the current
+    sys.stdout, or dropped if quiet is true."""
+    softspace = 0
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+
+    def write(self, text):
+        if not self.quiet:
+            sys.stdout.write(text)
+
+class _IncludeFile:
+    """A file included by @@@CODE/@@@DATA statements. The file is
+    memory-mapped, so only the parts of the file that are searched or
+    included are read from disk. The positions of start/stop expressions
+    are recorded in an offset index as they are looked up, such that
+    several includes from the same file do not search the same text
+    twice."""
+    def __init__(self, filename, resolver=None):
+        """The text of the file is resolver(filename) if a resolver
+        function is given (see convert). self.text is a string or an
+        mmap object (which has the same find, rfind, slicing and len)."""
+        self.filename = filename
+        self.mapped = False  # is self.text an mmap object?
+        if resolver is None:
+            f = open(filename, 'rb')
+            try:
+                import mmap
+                self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mapped = True
+            except (ValueError, EnvironmentError):
+                # empty files (and files that cannot be mapped) are read
+                self.text = f.read()
+            f.close()
+        else:
+            try:
+                self.text = resolver(filename)
+            except IOError:
+                raise
+            except Exception, e:
+                raise Ptex2texError('include_resolver failed for %s: %s: %s' % (filename, e.__class__.__name__, e), 2)
+        self.offsets = {}
+        self.symbols = None  # symbol index (see _Ptex2tex.symbol_lines)
+
+    def close(self):
+        if self.mapped:
+            self.text.close()
+            self.mapped = False
+
+    def find(self, expression, start=0):
+        """Return the position of the first occurrence of expression
+        at or after position start (-1 if not found)."""
+        key = (expression, start)
+        if key not in self.offsets:
+            self.offsets[key] = self.text.find(expression, start)
+        return self.offsets[key]
+
+    def search(self, pattern, start=0, limit=None):
+        """Return the start and end positions of the first match of the
+        compiled regular expression pattern at or after position start
+        ((-1, -1) if not found). The pattern is matched against one line
+        at a time, and patterns starting with ^ are only tried at the
+        line starts. The search is stopped after limit seconds (if not
+        None), see time_limited."""
+        key = (pattern, start)
+        if key not in self.offsets:
+            position = time_limited(self.search_lines, (pattern, start),
+                                    limit)
+            if position is None:
+                raise Ptex2texError('regular expression "%s" took more than %g seconds in %s (catastrophic backtracking?) - abort' % (pattern.pattern, limit, self.filename), 1)
+            self.offsets[key] = position
+        return self.offsets[key]
+
+    def search_lines(self, pattern, start):
+        text = self.text
+        anchored = pattern.pattern.startswith('^')
+        position = (-1, -1)
+        begin = start
+        while begin <= len(text):
+            end = text.find('\n', begin)
+            if end < 0:
+                end = len(text)
+            if anchored:
+                m = pattern.match(text, begin, end)
+            else:
+                m = pattern.search(text, begin, end)
+            if m:
+                position = m.span()
+                break
+            begin = end + 1
+        return position
+
+    def lines(self, first, last):
+        """Return the start and stop positions of line first to line
+        last (counted from 1, last is included). Only the text up to
+        line last is searched."""
+        start = 0
+        for i in range(first - 1):
+            start = self.text.find('\n', start) + 1
+            if start == 0:
+                return len(self.text), len(self.text)
+        stop = start
+        for i in range(last - first + 1):
+            stop = self.text.find('\n', stop) + 1
+            if stop == 0:
+                return start, len(self.text)
+        return start, stop
+
+    def tail(self, n):
+        """Return the start and stop positions of the last n lines.
+        Only the text in these lines is searched."""
+        stop = len(self.text)
+        end = stop
+        if self.text[end-1:end] == '\n':
+            end -= 1  # the newline of the last line
+        for i in range(n):
+            end = self.text.rfind('\n', 0, end)
+            if end < 0:
+                return 0, stop
+        return end + 1, stop
+
+
 class _Ptex2tex:
     __doc__ = doc()
 
-    def __init__(self, argv=sys.argv):
+    def __init__(self, argv=sys.argv, supported=None):
         """
+        The file to be converted is the last argument in argv.
+        If supported is given, it is used as the table of environments
+        instead of reading the config files (see envs.envs). The table
+        is not changed, so the same table can be used for many
+        conversions.
+
         Command-line arguments:
         -v: turn on verbose mode
         -DVAR: define    variable/macro VAR (can be many of these)
         -UVAR: undefine  variable/macro VAR (can be many of these)
+        --keep-intermediate: write the intermediate .tmp1/.tmp2 files
+        --cache: reuse @@@CODE/@@@DATA regions and the parsed config
+                 files from previous runs
+        -j N: run up to N @@@CMD commands concurrently (default: no of cores)
+        --cmd-cache: reuse the output of @@@CMD commands from previous runs
+        --no-cmd-cache: turn off --cmd-cache
+        --watch: convert again each time an input file changes
+        --if-changed: skip the conversion if no input file has changed
+                      since the previous conversion with --if-changed
+        --depfile: write the input files to a Makefile depfile FILE.d
+        --timings: print the wall and CPU time and the size of the
+                   input and output text of each stage
+        --profile PFILE: run the conversion under cProfile and write the
+                         statistics to PFILE (for the pstats module)
+        --pygments: highlight the code in Minted_* environments with
+                    Pygments (no -shell-escape needed for LaTeX)
+        --pygments-style STYLE: Pygments style (default: default)
+        --lazy-envs: only create the environments used in the document
+        --regex: treat the start/stop expressions of @@@CODE/@@@DATA as
+                 regular expressions (re: does so for one statement)
+        --regex-timeout S: stop a --regex/re: search after S seconds
+                           (default: 5)
+        --cmd-timeout S: kill an @@@CMD command after S seconds
+        --cmd-total-timeout S: kill the @@@CMD commands still running
+                               S seconds after the first one started
+        --cmd-max-output N: cut the output of an @@@CMD command after
+                            N bytes (default: 16 MB, 0: no limit)
 
         All other options are controlled by the config file.
         """
 
+        self.argv = argv
+        self.out = _Messages()  # progress messages (quiet in convert)
+        self.pretext = None  # output of inline_tt, reused by watch
+        self.preprocess_dependencies = []
+        self.include_dependencies = []
+        self.command_dependencies = []
         # Define temporary files:
         self.file = argv[-1]
         filetype = os.path.splitext(self.file)
         if (filetype[1] == ".tex") and (filetype[0].split('.')[-1] == 'p'):
             self.file = os.path.splitext(filetype[0])[0]
         elif len(os.path.splitext(self.file)[1]) > 0:
-            print "extension %s is illegal," %os.path.splitext(self.file)[1],
-            print "this script should only be called for .p.tex files"
-            sys.exit(1)
+            raise Ptex2texError("extension %s is illegal, this script should only be called for .p.tex files" % os.path.splitext(self.file)[1], 1)
         self.ptexfile = self.file+".p.tex"
         self.preoutfile = self.file+".tmp1"
         self.transfile = self.file+".tmp2"
         self.texfile = self.file+".tex"
+        self.depfile = self.file+".d"
+        # the cache entries of the document start with this name:
+        self.document = os.path.abspath(self.ptexfile)
 
         self.verbose = True if '-v' in argv else False
+        # The stages pass the text to each other in memory; the
+        # intermediate files are only written for debugging purposes:
+        self.keep_intermediate = '--keep-intermediate' in argv
+        # -j N: number of @@@CMD commands to run concurrently
+        self.jobs = jobs(argv)
+        # limits of the @@@CMD commands: the time of each command, the
+        # time of all the commands, and the output of each command in
+        # bytes (0: no limit):
+        self.cmd_timeout = number_option(argv, '--cmd-timeout')
+        self.cmd_total_timeout = number_option(argv, '--cmd-total-timeout')
+        self.cmd_max_output = number_option(argv, '--cmd-max-output', int,
+                                            cmd_max_output) or None
+        # Regions of files included by @@@CODE/@@@DATA are stored in a
+        # persistent cache if --cache is given:
+        if '--cache' in argv:
+            self.snippet_cache = cache.Cache(
+                os.path.dirname(self.ptexfile), 'snippets')
+        else:
+            self.snippet_cache = None
+        # Output from @@@CMD commands is stored in a persistent cache if
+        # --cmd-cache is given (and --no-cmd-cache is not):
+        if '--cmd-cache' in argv and not '--no-cmd-cache' in argv:
+            self.cmd_cache = cache.Cache(
+                os.path.dirname(self.ptexfile), 'commands')
+        else:
+            self.cmd_cache = None
+        # The input files of each conversion are recorded with
+        # --if-changed, and the conversion is skipped if they are unchanged
+        # (one file per document, such that documents converted at the
+        # same time do not overwrite each other's records):
+        if '--if-changed' in argv:
+            self.dependency_cache = cache.Cache(
+                os.path.dirname(self.ptexfile),
+                os.path.join('dependencies', os.path.basename(self.file)))
+        else:
+            self.dependency_cache = None
+        self.write_depfile = '--depfile' in argv
+        # True if the last run wrote a new .tex file (False if unchanged):
+        self.changed = None
+        # --regex: the start/stop expressions in @@@CODE/@@@DATA are
+        # regular expressions (re: before the expressions does the same
+        # for one statement); a search is stopped after --regex-timeout
+        # seconds:
+        self.regex = '--regex' in argv
+        self.regex_timeout = number_option(argv, '--regex-timeout',
+                                           default=regex_timeout)
+        # --pygments: Minted_* environments are highlighted by ptex2tex,
+        # and the results are cached (in .ptex2tex-cache with --cache):
+        self.pygments = '--pygments' in argv
+        self.pygments_style = option_value(argv, '--pygments-style',
+                                           'default')
+        if '--cache' in argv:
+            self.highlight_cache = cache.Cache(
+                os.path.dirname(self.ptexfile), 'highlight')
+        else:
+            self.highlight_cache = cache.Cache(None, 'highlight')
+        # Index of the symbols in files included by @@@CODE file symbol:NAME
+        # (in .ptex2tex-cache with --cache):
+        if '--cache' in argv:
+            self.symbol_cache = cache.Cache(
+                os.path.dirname(self.ptexfile), 'symbols')
+        else:
+            self.symbol_cache = cache.Cache(None, 'symbols')
+        self.minted = {}  # environment key -> minted options (see convert)
+        # function returning the text of @@@CODE/@@@DATA files (see convert):
+        self.include_resolver = None
+        # callbacks called before and after each stage (see run_stage):
+        self.on_stage_start = []
+        self.on_stage_end = []
+        # --timings: collect the time and text sizes of each stage
+        self.timings = []
+        if '--timings' in argv:
+            self.on_stage_end.append(self.record_timing)
+        # --profile FILE: write cProfile statistics to FILE
+        self.profile = option_value(argv, '--profile')
         # other command-line args are defined below
 
         # Returns a dict where the keys are the names of the classes,
         # and the values are a tuple consisting of an instance of the class,
         # as well as the begin and end codes:
-        self.supported = envs.envs(os.path.dirname(self.ptexfile))
+        # --lazy-envs: only the environments used in the document
+        # (see document_tokens) are created
+        self.lazy_envs = '--lazy-envs' in argv and self.file != '-'
+        if supported is None:
+            tokens = None
+            if self.lazy_envs:
+                tokens = self.document_tokens()
+            supported = envs.envs(os.path.dirname(self.ptexfile),
+                                  cache='--cache' in argv, tokens=tokens,
+                                  out=self.out)
+        self.supported = supported.copy()
 
         # [preprocess] section contains defines/undefines
         # (a list of macro names)
@@ -194,13 +645,49 @@ class _Ptex2tex:
         # [inline_code] section has the font item for \code and \emp commands:
         self.inline_code = self.supported.pop('inline_code')
         if not 'font' in self.inline_code:
-            print "missing option 'font' in inline code"
-            sys.exit(5)
+            raise Ptex2texError("missing option 'font' in inline code", 5)
         if 'verb_command' in self.inline_code:
             self.verb_command = self.inline_code['verb_command']
         else:
             self.verb_command = 'Verb'  # default
 
+        # Dispatch table from the begin and end markers (\bNAME, \eNAME)
+        # to the environment keys, such that convert can classify each
+        # line without scanning through all the environments:
+        self.markers = {}
+        for key in self.supported:
+            value = self.supported[key]
+            self.markers[value[1]] = key
+            self.markers[value[2]] = key
+        self.markers_maxlen = max([len(m) for m in self.markers] + [0])
+
+    def document_tokens(self):
+        """Return the words after \\b and \\e at the beginning of the
+        lines in the .p.tex file and in the files it includes by
+        '% #include' statements (see envs.marker_tokens). Return None
+        (all environments are needed) if the file or an included file
+        is not found."""
+        directories = [argv_i for i, argv_i in enumerate(self.argv[1:])
+                       if self.argv[i] == '-I']
+        tokens = []
+        files = [self.ptexfile]
+        for filename in files:
+            try:
+                text = open(filename).read()
+            except IOError:
+                return None
+            tokens.extend(envs.marker_tokens(text))
+            for name in preprocess_include_pattern.findall(text):
+                for directory in [os.path.dirname(filename)] + directories:
+                    path = os.path.join(directory, name)
+                    if os.path.isfile(path):
+                        if path not in files:
+                            files.append(path)
+                        break
+                else:
+                    # maybe in an include directory in the config file
+                    return None
+        return tokens
 
     def strip(self, text):
         """Remove empty lines, but not single white-spaces.
@@ -220,124 +707,140 @@ class _Ptex2tex:
         stopline = len(lines) - stopline
         return '\n'.join(lines[startline:stopline]).strip('\n')
 
-    def preprocessor(self):
-        """Run the preprocessor command on the file (if available)."""
-        if not os.path.isfile(self.ptexfile):
-            print "file %s not found" % self.ptexfile
-            sys.exit(2)
-        try:
-            import preprocess
-        except:
-            print 'could not find the preprocess program, skipping preprocessing...'
-            open(self.preoutfile, 'w').write(open(self.ptexfile).read())
-            return
-        print "running preprocessor on %s... " % self.ptexfile,
-        if self.preprocess_defines:
-            h = [name for name in self.preprocess_defines]
-            print 'defines: %s ' % (str(h)[1:-1]),
-        if self.preprocess_includes:
-            print 'includes: %s ' % (str(self.preprocess_includes)[1:-1]),
-        preprocess.preprocess(self.ptexfile, self.preoutfile,
-                              defines=self.preprocess_defines,
-                              includePath=self.preprocess_includes,
-                              substitute=self.preprocess_substitute,
-                              force=1)
-        print "done"
-
-    def inline_tt(self):
-        """Replace the \emp and \code environments with raw latex code."""
-        lines = open(self.preoutfile).read()
-
-        # \emp{} commands: replace with \texttt{} and font adjustment
-        pattern = re.compile(r'\\emp\{(.*?)\}') #, re.DOTALL)
-        if self.inline_code['font'] == 'smaller':
-            lines = re.sub(pattern, r'{\smaller\\texttt{\1}\larger{}}', lines)
-        else:
-            fontsize = int(self.inline_code['font'])
-            lines = re.sub(pattern, r'{\\fontsize{%spt}{%spt}\\texttt{\1}}' % (fontsize, fontsize), lines)
+    def preprocessor(self, text=None, defines=None):
+        """Run the built-in preprocessor (see directives.py) on the file,
+        or on text if given. Return the preprocessed text. defines is the
+        dict of preprocessor variables (default: a copy of the -D options
+        and the defines in the config file); it is updated by #define and
+        #undef statements, such that a document can be preprocessed in
+        several blocks."""
+        if text is None and not os.path.isfile(self.ptexfile):
+            raise Ptex2texError("file %s not found" % self.ptexfile, 2)
+        self.preprocess_dependencies = []
+        filename = None
+        if text is None:
+            filename = self.ptexfile
+            text = open(filename).read()
+        # Text without preprocessor statements is not changed (unless
+        # variables are substituted):
+        if not self.preprocess_substitute and \
+               not preprocess_statement_pattern.search(text):
+            return text
+        from ptex2tex.directives import Preprocessor
+        if defines is None:
+            defines = dict(self.preprocess_defines)
+        preprocessor = Preprocessor(defines, self.preprocess_includes,
+                                    self.preprocess_substitute)
+        if filename is not None:
+            print >>self.out, "running preprocessor on %s... " % filename,
+            if self.preprocess_defines:
+                h = [name for name in self.preprocess_defines]
+                print >>self.out, 'defines: %s ' % (str(h)[1:-1]),
+            if self.preprocess_includes:
+                print >>self.out, 'includes: %s ' % (str(self.preprocess_includes)[1:-1]),
+        text = preprocessor.process(text, filename)
+        self.preprocess_dependencies = preprocessor.included
+        if filename is not None:
+            print >>self.out, "done"
+        return text
 
+    def inline_tt(self, lines):
+        """Replace the \\emp and \\code environments with raw latex code.
+        The text is scanned once, and each \\emp{}, \\code{} and
+        \\protect\\code{} construction is replaced where it is found."""
+
+        # \emp{} commands: replace with \texttt{} and font adjustment.
         # several \code{} commands: replace with \verb!..! and font adjustment
         # (i.e., \verb is actually \ + self.verb_command, and verb_command
         # is set in the config file
+        if self.inline_code['font'] == 'smaller':
+            emp_begin, emp_end = r'{\smaller\texttt{', r'}\larger{}}'
+            code_begin, code_end = r'{\smaller', r'\larger{}}'
+        else:
+            fontsize = int(self.inline_code['font'])
+            emp_begin = r'{\fontsize{%spt}{%spt}\texttt{' % (fontsize, fontsize)
+            emp_end = r'}}'
+            if fontsize != 10:
+                code_begin = r'{\fontsize{%spt}{%spt}' % (fontsize, fontsize)
+            else:
+                code_begin = r'{'
+            code_end = r'}'
 
         # NO: \code{} inside captions, headings, tabular headings require
-        # \_ (that is why the code below is commented out)
-        # first, remove backslashes (if present - these are never necessary,
-        # and they should be removed from old documents)
-        """
-        pattern = re.compile(r'\\code\{([^}]*?)\\_\\_([^}]*?)\\_\\_(.*?)\}') #, re.DOTALL) # re.DOTALL is problematic because verb!...! cannot have newline
-        lines = re.sub(pattern, r'\code{\1__\2__\3}', lines)
-        no_of_backslashes = 5
-        for i in range(no_of_backslashes):
-            # Handle up to no_of_backslashes in backslash constructions
-            pattern = re.compile(r'\\code\{([^}]*?)\\([_#%$@])(.*?)\}', re.DOTALL)
-            lines = re.sub(pattern, r'\code{\1\2\3}', lines)
-        """
-
-        # remove one newline (two implies far too long inline verbatim
-        pattern = re.compile(r'\\code\{([^\n}]*?)\n(.*?)\}', re.DOTALL)
-        # (this pattern does not handle \code{...} with internal } AND \n!)
-        lines = re.sub(pattern, r'\code{\1 \2}', lines)
-        pattern = re.compile(r'\\code\{([^\n}]*?)\n(.*?)\}', re.DOTALL)
-        m = pattern.search(lines)
-        if m:
-            print r'The following text contains the \code{} command with a newline - remove the newline(s):'
-            print r'\code{%s\n%s}' % (m.group(1), m.group(2))
-            sys.exit(1)
-
-        # now all \code{} are without backslashes and newline
-        # (note that we need the 2nd group to handle } inside the code
-        # argument)
+        # \_ (that is why backslashes are not removed from the argument)
 
         # note: \code{} cannot contain ! as this character is used as
-        # delimiter
+        # delimiter, ~ is used as delimiter in that case
         verb_delimiter = '!'
         alt_verb_delimiter = '~'
-        pattern = re.compile(r"""\\code\{(.*?)\}([ \n,.;:?!)"'-])""", re.DOTALL)
-        for verbatim, ending in pattern.findall(lines):
+
+        output = []
+        pos = 0              # text before pos is copied to output
+        search_pos = 0
+        code_closed = True   # False when no \code{} can be closed anymore
+        while True:
+            m = inline_pattern.search(lines, search_pos)
+            if not m:
+                break
+            start = m.end()
+            if m.group().startswith(r'\emp'):
+                # the argument of \emp{} cannot contain } or newline
+                end = emp_end_pattern.search(lines, start)
+                if end is None or end.group() != '}':
+                    search_pos = m.start() + 1
+                    continue
+                stop = end.start()
+                output.append(lines[pos:m.start()])
+                output.append(emp_begin + lines[start:stop] + emp_end)
+                pos = search_pos = stop + 1
+                continue
+
+            # \code{} (or \protect\code{}) ends with a } followed by one of
+            # the code_endings characters (this handles } inside the code)
+            stop = -1
+            if code_closed:
+                stop = lines.find('}', start)
+                while 0 <= stop < len(lines) - 1 and \
+                          lines[stop+1] not in code_endings:
+                    stop = lines.find('}', stop + 1)
+                if stop == len(lines) - 1:
+                    stop = -1
+                if stop < 0:
+                    code_closed = False
+            if stop < 0:
+                search_pos = m.end()
+                continue
+            verbatim = lines[start:stop]
+
+            # remove one newline (two implies far too long inline verbatim)
+            for i in range(2):
+                newline = verbatim.find('\n')
+                if newline < 0 or 0 <= verbatim.find('}') < newline:
+                    break
+                if i == 1:
+                    raise Ptex2texError(r'The following text contains the \code{} command with a newline - remove the newline(s):' + '\n' + r'\code{%s}' % verbatim, 1)
+                verbatim = verbatim[:newline] + ' ' + verbatim[newline+1:]
+
+            delimiter = verb_delimiter
             if verb_delimiter in verbatim:
                 if alt_verb_delimiter in verbatim:
-                    print """
+                    print >>self.out, """
 *** warning: inline verbatim "%s"
     contains both delimiters %s and %s that the \\%s LaTeX
-    command \\Verb will use - be prepared for strange output that
+    command will use - be prepared for strange output that
     requires manual editing (or use doconce replace/subst)
-""" % (verbatim, verb_delimiter, alt_verb_delimiter)
-                if self.inline_code['font'] == 'smaller':
-                    lines = re.sub(r'\\protect\s*\\code\{%s\}' % verbatim, r'{\smaller\protect\\%s%s%s%s\larger{}}' % (self.verb_command, alt_verb_delimiter, verbatim, alt_verb_delimiter), lines)
-                    lines = re.sub(r'\\code\{%s\}' % verbatim, r'{\smaller\\%s%s%s%s\larger{}}' % (self.verb_command, alt_verb_delimiter, verbatim, alt_verb_delimiter,), lines)
-                else:
-                    fontsize = int(self.inline_code['font'])
-                    if fontsize != 10:
-                        fontstr = r'{\\fontsize{%spt}{%spt}' % (fontsize, fontsize)
-                    else:
-                        fontstr = r'{'
-                    lines = re.sub(r'\\protect\s*\\code\{%s\}' % verbatim, r'%s\protect\\%s%s%s%s}' % (fontstr, self.verb_command, alt_verb_delimiter, verbatim, alt_verb_delimiter), lines)
-                    lines = re.sub(r'\\code\{%s\}' % verbatim, r'%s\\%s%s%s%s}' % (fontstr, self.verb_command, alt_verb_delimiter, verbatim, alt_verb_delimiter), lines)
-
-        # Need special treatment of \protect\code such that \protect
-        # comes after fontsize and before \Verb
-        pattern = re.compile(r"""\\protect\s*\\code\{(.*?)\}([ \n,.;:?!)"'-])""", re.DOTALL)
-        if self.inline_code['font'] == 'smaller':
-            lines = pattern.sub(r'{\smaller\protect\\%s%s\1%s\larger{}}\2' % (self.verb_command, verb_delimiter, verb_delimiter), lines)
-        else:
-            fontsize = int(self.inline_code['font'])
-            if fontsize != 10:
-                fontstr = r'{\\fontsize{%spt}{%spt}' % (fontsize, fontsize)
-            else:
-                fontstr = r'{'
-            lines = pattern.sub(r'%s\protect\\%s%s\1%s}\2' % (fontstr, self.verb_command, verb_delimiter, verb_delimiter), lines)
+""" % (verbatim, verb_delimiter, alt_verb_delimiter, self.verb_command)
+                delimiter = alt_verb_delimiter
+            # \protect must come after fontsize and before \Verb
+            protect = r'\protect' if m.group(1) else ''
+            output.append(lines[pos:m.start()])
+            output.append('%s%s\\%s%s%s%s%s' % \
+                          (code_begin, protect, self.verb_command,
+                           delimiter, verbatim, delimiter, code_end))
+            pos = search_pos = stop + 1
+        output.append(lines[pos:])
+        lines = ''.join(output)
 
-        pattern = re.compile(r"""\\code\{(.*?)\}([ \n,.;:?!)"'-])""", re.DOTALL)
-        if self.inline_code['font'] == 'smaller':
-            lines = pattern.sub(r'{\smaller\\%s%s\1%s\larger{}}\2' % (self.verb_command, verb_delimiter, verb_delimiter), lines)
-        else:
-            fontsize = int(self.inline_code['font'])
-            if fontsize != 10:
-                fontstr = r'{\\fontsize{%spt}{%spt}' % (fontsize, fontsize)
-            else:
-                fontstr = r'{'
-            lines = pattern.sub(r'%s\\%s%s\1%s}\2' % (fontstr, self.verb_command, verb_delimiter, verb_delimiter), lines)
         # \Verb!...! does not cause linebreak in latex, shift to \texttt{}
         # where possible since this will reduce overfull hboxes
         lines = re.sub(r'\{\\Verb!([^{}_$\^#&%\\]+?)!\}',
@@ -345,164 +848,405 @@ class _Ptex2tex:
         lines = re.sub(r'\{\\protect\s*\\Verb!([^{}_$\^#&%\\]+?)!\}',
                         r'\\texttt{\g<1>}', lines)
 
+        return lines
 
-        open(self.preoutfile, 'w').write(lines)
-
-    def include_file(self):
-        """Read from preoutfile file and write to transfile. If no include
-        statements (statement variable) are found, copy directly to transfile."""
+    def include_file(self, lines):
+        """Insert the files (or parts of files) specified by the include
+        statements in the text. If no include statements (statement
+        variable) are found, the text is returned unaltered."""
         self.code_statement = code_statement
         self.data_statement = data_statement
-        infile = open(self.preoutfile)
-        lines = infile.read()
+        self.include_dependencies = []
         if lines.find(self.code_statement) < 0 and lines.find(self.data_statement) < 0:
-            shutil.copy(self.preoutfile, self.transfile)
-            return
-        outfile = open(self.transfile, 'w')
+            return lines
+        outfile = []
+        # files are read only once per run:
+        self.include_files = {}
         if self.verbose:
             '\n\n*** Include text from file:'
-            print self.transfile
+            print >>self.out, self.transfile
         lines = lines.splitlines()
         #if self.verbose: print lines
-        for line in lines:
-            code_found = line.startswith(self.code_statement)
-            data_found = line.startswith(self.data_statement)
-            if code_found or data_found:
-                codefilename = line.split()[1]
-                if self.verbose: print 'will copy from', codefilename
-                try:
-                    codefile = open(codefilename, 'r')
-                except:
-                     print "include file %s could not be found" %codefilename
-                     sys.exit(2)
-                code = codefile.read()
-                codeline = string.join(line.split()[2:])
-                if self.verbose: print 'start-stop specification:', codeline
-                if codeline.find('@') < 0:
-                    codeline += '@'
-                regex = codeline.split('@')
-                for i in range(len(regex)):
-                    regex[i] = regex[i].strip()
-                if self.verbose: print 'interpreted start-stop text:', regex
-                startexp = None
-                start = 0
-                stop = len(code)-1
-                whole = False
-                if len(regex[0]) > 0:
-                    if len(regex) > 2:
-                        whole = True
-                    startexp = regex[0].strip();
-                    startexp = startexp.replace('~', ' ')
-                    if len(regex[1].strip()) > 1:
-                        stopexp = regex[1]
-                        stopexp = stopexp.replace('~', ' ')
-		    else:
-			stopexp = ""
-                    if self.verbose: print 'final start-stop expressions:', [startexp, stopexp]
-                    start = code.find(startexp)
-                    while code[start-1] == ' ':
-                        start -= 1
-                    if start < 0:
-                        print "start expression not found for %s" %codefilename
-                        print 'will start from the beginning of the file'
-                        start = 0
-		    if startexp and stopexp:
-                        stop = start + code[start:].find(stopexp)
-		    else:
-			stop = len(code)
-                    if stop < 0:
-                        print "stop expression not found for %s" %codefilename
-                        sys.exit(3)
-                    if self.verbose: print 'copy from pos', start, 'to', stop
-                    if start > stop:
-                        print 'copying: start "%s" at char %d, end "%s" at char %d < %d - this is not what you intended - abort' % (startexp, start, stopexp, stop, start)
-                        sys.exit(1)
-                    code = code[start:stop].rstrip()
-                if self.verbose:
-                    print "copying in the following text: [%s]" % code
-                if startexp and stopexp:
-                    if start == 0:
-                        regex[0] = 'BOF'
-                    insstr = 'from "%s" to "%s"' %(regex[0], regex[1])
-                elif startexp:
-                    insstr = "from %s to end of file" %regex[0]
-                else:
-                    insstr = "everything"
-                print "copying %s,\n        in file %s, char %d-%d...." % (insstr, codefilename, start, stop),
-                if code.strip() == '':
-                    print 'EMPTY REGION!'
-                    sys.exit(1)
-
-                if startexp and not whole:
-                    if code_found:
-                        outfile.write(self.supported['sni'][1]+"\n")
-                    elif data_found:
-                        outfile.write(self.supported['dsni'][1]+"\n")
-                else:
-                    if code_found:
-                        outfile.write(self.supported['pro'][1]+"\n")
-                    elif data_found:
-                        outfile.write(self.supported['dat'][1]+"\n")
-                outfile.write(self.strip(code))
-                if code:
-                    if code[-1] is not "\n":
-                        outfile.write("\n")
-                if startexp and not whole:
-                    if code_found:
-                        outfile.write(self.supported['sni'][2]+"\n")
-                    elif data_found:
-                        outfile.write(self.supported['dsni'][2]+"\n")
+        try:
+            for line in lines:
+                code_found = line.startswith(self.code_statement)
+                data_found = line.startswith(self.data_statement)
+                if code_found or data_found:
+                    codefilename = line.split()[1]
+                    if self.verbose: print >>self.out, 'will copy from', codefilename
+                    self.include_dependencies.append(codefilename)
+                    codeline = ' '.join(line.split()[2:])
+                    if self.verbose: print >>self.out, 'start-stop specification:', codeline
+                    # head=N, tail=N and lines=A-B select lines of the file,
+                    # symbol:NAME the lines of a function, class or method:
+                    form = line_region_pattern.match(codeline)
+                    symbol = symbol_pattern.match(codeline)
+                    use_regex = self.regex and not (form or symbol)
+                    if codeline.startswith('re:'):
+                        codeline = codeline[3:].strip()
+                        use_regex = True
+                    if codeline.find('@') < 0:
+                        codeline += '@'
+                    regex = codeline.split('@')
+                    for i in range(len(regex)):
+                        regex[i] = regex[i].strip()
+                    if self.verbose and not (form or symbol):
+                        print >>self.out, 'interpreted start-stop text:', regex
+                    startexp = None
+                    stopexp = None
+                    whole = False
+                    if form:
+                        kind = form.group(1) or 'lines'
+                        first = int(form.group(2) or form.group(3))
+                        last = form.group(4) and int(form.group(4))
+                        startexp = (kind, first, last)  # key in the snippet cache
+                    elif symbol:
+                        startexp = ('symbol', symbol.group(1))
+                    elif len(regex[0]) > 0:
+                        if len(regex) > 2:
+                            whole = True
+                        startexp = regex[0].strip();
+                        if not use_regex:
+                            startexp = startexp.replace('~', ' ')
+                        if len(regex[1].strip()) > 1:
+                            stopexp = regex[1]
+                            if not use_regex:
+                                stopexp = stopexp.replace('~', ' ')
+                        else:
+                            stopexp = ""
+                        if self.verbose: print >>self.out, 'final start-stop expressions:', [startexp, stopexp]
+
+                    # Unchanged files (same modification time and size) are
+                    # served from the snippet cache without being read:
+                    region = None
+                    if self.snippet_cache is not None:
+                        try:
+                            stat = os.stat(codefilename)
+                        except OSError:
+                            raise Ptex2texError("include file %s could not be found" % codefilename, 2)
+                        key = (self.document, os.path.abspath(codefilename),
+                               stat.st_mtime,
+                               stat.st_size, startexp, stopexp, use_regex)
+                        region = self.snippet_cache.get(key)
+                    if region is None:
+                        if form:
+                            region = self.include_lines(codefilename, kind,
+                                                        first, last)
+                        elif symbol:
+                            first, last = self.symbol_lines(codefilename,
+                                                            symbol.group(1))
+                            region = self.include_lines(codefilename, 'lines',
+                                                        first, last)
+                        else:
+                            region = self.include_region(codefilename,
+                                                         startexp, stopexp,
+                                                         use_regex)
+                        if self.snippet_cache is not None:
+                            self.snippet_cache.set(key, region)
+                    code, start, stop = region
+                    if self.verbose:
+                        print >>self.out, "copying in the following text: [%s]" % code
+                    if symbol:
+                        insstr = symbol.group(1)
+                    elif form and kind == 'lines':
+                        insstr = 'lines %d-%d' % (first, last)
+                    elif form:
+                        insstr = '%s %d lines' % \
+                                 ({'head': 'first', 'tail': 'last'}[kind], first)
+                    elif startexp and stopexp:
+                        if start == 0:
+                            regex[0] = 'BOF'
+                        insstr = 'from "%s" to "%s"' %(regex[0], regex[1])
+                    elif startexp:
+                        insstr = "from %s to end of file" %regex[0]
+                    else:
+                        insstr = "everything"
+                    print >>self.out, "copying %s,\n        in file %s, char %d-%d...." % (insstr, codefilename, start, stop),
+                    if code.strip() == '':
+                        raise Ptex2texError('EMPTY REGION!', 1)
+
+                    if startexp and not whole:
+                        if code_found:
+                            outfile.append(self.supported['sni'][1]+"\n")
+                        elif data_found:
+                            outfile.append(self.supported['dsni'][1]+"\n")
+                    else:
+                        if code_found:
+                            outfile.append(self.supported['pro'][1]+"\n")
+                        elif data_found:
+                            outfile.append(self.supported['dat'][1]+"\n")
+                    outfile.append(code)
+                    if startexp and not whole:
+                        if code_found:
+                            outfile.append(self.supported['sni'][2]+"\n")
+                        elif data_found:
+                            outfile.append(self.supported['dsni'][2]+"\n")
+                    else:
+                        if code_found:
+                            outfile.append(self.supported['pro'][2]+"\n")
+                        elif data_found:
+                            outfile.append(self.supported['dat'][2]+"\n")
+                    print >>self.out, "done"
+
                 else:
-                    if code_found:
-                        outfile.write(self.supported['pro'][2]+"\n")
-                    elif data_found:
-                        outfile.write(self.supported['dat'][2]+"\n")
-                print "done"
+                    outfile.append(line+"\n")
+                code_found = False; data_found = False; whole = False
+        finally:
+            # (the files are also closed if an include fails)
+            for codefile in self.include_files.values():
+                codefile.close()
+            self.include_files = {}
+        self.symbol_cache.save()
+        if self.snippet_cache is not None:
+            self.snippet_cache.save()
+            if self.verbose: print >>self.out, self.snippet_cache.summary()
+        return ''.join(outfile)
+
+    def include_file_object(self, codefilename):
+        """Return the _IncludeFile object for codefilename (each file
+        is opened once per run)."""
+        if codefilename not in self.include_files:
+            try:
+                self.include_files[codefilename] = _IncludeFile(
+                    codefilename, self.include_resolver)
+            except IOError:
+                raise Ptex2texError("include file %s could not be found" % codefilename, 2)
+        return self.include_files[codefilename]
+
+    def include_lines(self, codefilename, form, a, b=None):
+        """Extract lines of the file codefilename: the first a lines
+        (form 'head'), the last a lines (form 'tail') or line a to
+        line b (form 'lines'). Return the text to be inserted in the
+        environment, and the start and stop positions of the region."""
+        if a < 1:
+            spec = '%s=%d' % (form, a) if b is None else 'lines=%d-%d' % (a, b)
+            raise Ptex2texError('copying: %s in %s selects no lines (lines are counted from 1) - abort' % (spec, codefilename), 1)
+        codefile = self.include_file_object(codefilename)
+        if form == 'head':
+            start, stop = codefile.lines(1, a)
+        elif form == 'tail':
+            start, stop = codefile.tail(a)
+        else:
+            if a > b:
+                raise Ptex2texError('copying: lines %d-%d in %s - the first line is after the last line - abort' % (a, b, codefilename), 1)
+            start, stop = codefile.lines(a, b)
+        code = codefile.text[start:stop].rstrip()
+        text = self.strip(code)
+        if code:
+            text += "\n"
+        return text, start, stop
+
+    def symbol_lines(self, codefilename, name):
+        """Return the first and last line of the function, class or
+        method name (e.g. MyClass.method) in the Python file
+        codefilename. The symbol index of the file is built once and
+        stored in the symbol cache under the hash of the file."""
+        codefile = self.include_file_object(codefilename)
+        if codefile.symbols is None:
+            from ptex2tex import symbols
+            text = codefile.text[:]
+            key = (self.document, symbols.text_hash(text))
+            codefile.symbols = self.symbol_cache.get(key)
+            if codefile.symbols is None:
+                codefile.symbols = symbols.index(text, codefilename)
+                self.symbol_cache.set(key, codefile.symbols)
+        if name not in codefile.symbols:
+            raise Ptex2texError("symbol %s not found in %s" % (name, codefilename), 3)
+        return codefile.symbols[name]
+
+    def include_region(self, codefilename, startexp, stopexp, regex=False):
+        """Extract the text between startexp and stopexp in the file
+        codefilename (the whole file if startexp is None). If regex is
+        true, startexp and stopexp are regular expressions. Return the
+        text to be inserted in the environment, and the start and stop
+        positions of the region."""
+        codefile = self.include_file_object(codefilename)
+        code = codefile.text
+        start = 0
+        stop = len(code)-1
+        if startexp:
+            if regex:
+                start, after = codefile.search(compile_regex(startexp), 0,
+                                               self.regex_timeout)
+            else:
+                start = after = codefile.find(startexp)
+            while start > 0 and code[start-1] == ' ':
+                start -= 1
+            if start < 0:
+                print >>self.out, "start expression not found for %s" %codefilename
+                print >>self.out, 'will start from the beginning of the file'
+                start = 0
+            if stopexp and regex:
+                # (a regular expression for the stop is matched after
+                # the match of the start, such that ^def@^def works)
+                stop = codefile.search(compile_regex(stopexp),
+                                       max(after, 0), self.regex_timeout)[0]
+            elif stopexp:
+                stop = codefile.find(stopexp, start)
+            else:
+                stop = len(code)
+            if stop < 0:
+                raise Ptex2texError("stop expression not found for %s" % codefilename, 3)
+            if self.verbose: print >>self.out, 'copy from pos', start, 'to', stop
+            if start > stop:
+                raise Ptex2texError('copying: start "%s" at char %d, end "%s" at char %d < %d - this is not what you intended - abort' % (startexp, start, stopexp, stop, start), 1)
+            code = code[start:stop].rstrip()
+        else:
+            code = code[:]  # the whole file (as a string)
+        text = self.strip(code)
+        if code:
+            if code[-1] is not "\n":
+                text += "\n"
+        return text, start, stop
+
+    def parse_command(self, line):
+        """Return the command, the include option (the integer after
+        '#') and the nocache flag (#nocache) in a @@@CMD line."""
+        command = ' '.join(line.split()[1:])
+        if self.verbose: print >>self.out, command
+        nocache = '#nocache' in command
+        if nocache:
+            command = command.replace('#nocache', '').strip()
+        if len(command.split('#')) > 1:
+            command, include_cmd = command.split('#')
+            include_cmd = include_cmd.strip()
+            # Options:
+            #  0: Command not included
+            #  1: Command included, path stripped
+            #  2: Command included, path not stripped
+            #  3: Command included except for programname, path
+            #     stripped
+            #  4: Command included except for programname, path not
+            #     stripped
+            # Default: 3
+            try:
+                include_cmd = int(include_cmd)
+            except:
+                print >>self.out, "argument after '#' in @@@CMD must be integer"
+            if self.verbose: print >>self.out, include_cmd
+        else:
+            include_cmd = 3
+        return command, include_cmd, nocache
 
+    def command_files(self, command):
+        """Return the names of the files named on the command line."""
+        import shlex
+        try:
+            words = shlex.split(command)
+        except ValueError:
+            words = command.split()
+        return [word for word in words if os.path.isfile(word)]
+
+    def command_key(self, command):
+        """Return the key of command in the command cache: the document,
+        the command, the working directory and the hash of each file that is named on
+        the command line."""
+        import hashlib
+        files = []
+        for word in self.command_files(command):
+            files.append((word, hashlib.sha1(open(word, 'rb').read()).hexdigest()))
+        return (self.document, command.strip(), os.getcwd(), tuple(files))
+
+    def run_commands(self, commandlist):
+        """Run the shell commands in commandlist, which is a list of
+        (command, nocache) pairs. Unless nocache is true, the output is
+        taken from the command cache (if active), and identical commands
+        are run only once. Return a list of (failure, output) in the
+        order of commandlist."""
+        results = [None]*len(commandlist)
+        indices = {}  # command key -> indices in commandlist
+        pending = []  # (command, key, indices) for the commands to be run
+        for i in range(len(commandlist)):
+            command, nocache = commandlist[i]
+            if self.cmd_cache is None or nocache:
+                pending.append((command, None, [i]))
+                continue
+            key = self.command_key(command)
+            if key in indices:
+                indices[key].append(i)
+                continue
+            indices[key] = [i]
+            result = self.cmd_cache.get(key)
+            if result is None:
+                pending.append((command, key, indices[key]))
             else:
-                outfile.write(line+"\n")
-            code_found = False; data_found = False; whole = False
-        outfile.close()
+                results[i] = result
+        outputs = self.execute_commands([command for command, key, i
+                                         in pending])
+        for (command, key, command_indices), result in zip(pending, outputs):
+            failure, output = result
+            if key is not None and not failure:
+                self.cmd_cache.set(key, result)
+            for i in command_indices:
+                results[i] = result
+        # fill in the duplicates of cached commands:
+        for key in indices:
+            for i in indices[key][1:]:
+                results[i] = results[indices[key][0]]
+        if self.cmd_cache is not None:
+            self.cmd_cache.save()
+            if self.verbose: print >>self.out, self.cmd_cache.summary()
+        return results
+
+    def execute_commands(self, commandlist):
+        """Run the shell commands on a pool of self.jobs worker threads,
+        within the time and output limits (see shell.run). Return a list
+        of (failure, output) in the order of commandlist."""
+        from ptex2tex import shell
+        deadline = None
+        if self.cmd_total_timeout is not None:
+            deadline = time.time() + self.cmd_total_timeout
+
+        def execute(command):
+            timeout = self.cmd_timeout
+            if deadline is not None:
+                left = max(deadline - time.time(), 0)
+                timeout = left if timeout is None else min(timeout, left)
+            status, output, timed_out = shell.run(command, timeout,
+                                                  self.cmd_max_output)
+            if timed_out:
+                output = (output and output + '\n') + \
+                         '*** killed after %.1f seconds ' \
+                         '(--cmd-timeout/--cmd-total-timeout)' % timeout
+            return status, output
 
-    def include_command(self):
-        """Function for including output from shell commands."""
+        if self.jobs > 1 and len(commandlist) > 1:
+            # the threads just wait for the shell processes
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.jobs, len(commandlist)))
+            try:
+                return pool.map(execute, commandlist)
+            finally:
+                pool.close()
+        return [execute(command) for command in commandlist]
+
+    def include_command(self, lines):
+        """Function for including output from shell commands.
+        All the commands are found first and run concurrently, then the
+        output is inserted in the text in the order of the commands."""
         self.statement = cmd_statement
-        infile = open(self.transfile)
-        lines = infile.read()
+        self.command_dependencies = []
         if lines.find(self.statement) < 0:
-            return
-        outfile = open(self.transfile, 'w')
+            return lines
+        outfile = []
         lines = lines.splitlines()
+        parsed = [self.parse_command(line) for line in lines
+                  if line.startswith(self.statement)]
+        for command, include_cmd, nocache in parsed:
+            self.command_dependencies.extend(self.command_files(command))
+        results = self.run_commands([(command, nocache) for
+                                     command, include_cmd, nocache
+                                     in parsed])
+        results.reverse()
+        parsed.reverse()
         for line in lines:
             if line.startswith(self.statement):
-                command = string.join(line.split()[1:])
-                if self.verbose: print command
-                if len(command.split('#')) > 1:
-                    command, include_cmd = command.split('#')
-                    include_cmd = include_cmd.strip()
-                    # Options:
-                    #  0: Command not included
-                    #  1: Command included, path stripped
-                    #  2: Command included, path not stripped
-                    #  3: Command included except for programname, path
-                    #     stripped
-                    #  4: Command included except for programname, path not
-                    #     stripped
-                    # Default: 3
-                    try:
-                        include_cmd = int(include_cmd)
-                    except:
-                        print "argument after '#' in @@@CMD must be integer"
-                    if self.verbose: print include_cmd
-                else:
-                    include_cmd = 3
-                failure, output = commands.getstatusoutput(command)
+                command, include_cmd, nocache = parsed.pop()
+                failure, output = results.pop()
                 if failure:
-                    print 'failed to run command', command
-                    print output
-                    sys.exit(4)
-                print "copying in output from %s..." %command.strip(),
-                outfile.write(self.supported['sys'][1] + "\n")
+                    raise Ptex2texError('failed to run command %s\n%s' % (command, output), 4)
+                print >>self.out, "copying in output from %s..." %command.strip(),
+                outfile.append(self.supported['sys'][1] + "\n")
                 if bool(int(include_cmd)):
                     if include_cmd == 1 or include_cmd == 3:
                         pattern = re.compile(r'\s+.*/')
@@ -510,60 +1254,616 @@ class _Ptex2tex:
                     if include_cmd == 3 or include_cmd == 4:
                         index = command.strip().find(' ')
                         command = command[index:].strip()
-                    outfile.write(command + '\n')
-                outfile.write(output + '\n')
-                outfile.write(self.supported['sys'][2] + "\n")
-                print "done"
+                    outfile.append(command + '\n')
+                outfile.append(output + '\n')
+                outfile.append(self.supported['sys'][2] + "\n")
+                print >>self.out, "done"
             else:
-                outfile.write(line + '\n')
-        outfile.close()
-
-    def convert(self):
-        """Function for converting from ptex to tex."""
-        infile = open(self.transfile)
-        outfile = open(self.texfile, 'w')
-        block = infile.read()
+                outfile.append(line + '\n')
+        return ''.join(outfile)
+
+    def match_marker(self, line, limit=None):
+        """Return the key of the environment whose begin or end marker
+        is the longest marker the line starts with (None if no marker
+        matches). Only keys smaller than limit are considered, if given."""
+        if line[:2] not in ('\\b', '\\e'):
+            return None
+        for length in range(min(len(line), self.markers_maxlen), 2, -1):
+            key = self.markers.get(line[:length])
+            if key is not None and (limit is None or key < limit):
+                return key
+        return None
+
+    def convert(self, block, defined=None):
+        """Function for converting from ptex to tex.
+        defined is a dict with the keys of the environments whose
+        newenv is already inserted (updated by convert, such that a
+        document can be converted in several blocks)."""
         lines = block.splitlines()
-        # Use the instances of the environments:
-        sorted_keys = self.supported.keys()
-        sorted_keys.sort()
-        sorted_keys.reverse()
-        for key in sorted_keys:
-            value = self.supported[key]
-            obj = value[0]
-            for i in range(len(lines)):
+        if defined is None:
+            defined = {}
+        if self.pygments:
+            lines = self.highlight_blocks(lines, defined)
+        # Use the instances of the environments. Each line is looked up
+        # in the marker dispatch table. The longest marker wins, and
+        # (as when the keys were processed in reverse sorted order)
+        # the replaced line is checked again against the smaller keys.
+        for i in range(len(lines)):
+            key = self.match_marker(lines[i])
+            if key is None:
+                if lines[i][:1].isspace() and \
+                       self.match_marker(lines[i].strip()) is not None:
+                    self._cleanup = False
+                    print >>self.out, '***warning: extra white-space detected, check line %d in %s' %(i, self.transfile)
+                continue
+            while key is not None:
+                value = self.supported[key]
+                obj = value[0]
                 if lines[i].startswith(value[1]):
-                    if obj.define:
-                        lines[i] = lines[i].replace(value[1], obj.newenv + value[1])
-                        obj.define = False
-                    lines[i] = lines[i].replace(value[1], obj.breplace)
-                elif lines[i].startswith(value[2]):
+                    if key not in defined:
+                        # the first use inserts newenv (if obj.define):
+                        lines[i] = lines[i].replace(value[1], obj.first_breplace)
+                        defined[key] = True
+                    else:
+                        lines[i] = lines[i].replace(value[1], obj.breplace)
+                else:
                     lines[i] = lines[i].replace(value[2], obj.ereplace)
-                elif lines[i].strip().startswith(value[1]) or lines[i].strip().startswith(value[2]):
-                    self._cleanup = False
-                    print '***warning: extra white-space detected, check line %d in %s' %(i, self.transfile)
-        block = '\n'.join(lines)
-        outfile.write(block)
-        print 'done %s -> %s' % (self.ptexfile, self.texfile)
-
-    def cleanup(self):
-        """Function for deleting temporary files."""
-        os.remove(self.preoutfile)
-        os.remove(self.transfile)
-
-    def run(self):
-        """Runs through the different functions necessary to complete the conversion."""
+                key = self.match_marker(lines[i], limit=key)
+        return '\n'.join(lines)
+
+    def highlight_blocks(self, lines, defined):
+        """Replace the blocks of Minted_* environments in the list lines
+        by the code highlighted by Pygments (--pygments), and return the
+        new list of lines. The blocks that are not in the highlight cache
+        are highlighted on a pool of -j processes. The definitions of the
+        Pygments commands are inserted before the first block (the key
+        'pygments style' is then added to the defined dict)."""
+        from ptex2tex import highlight
+        highlight.import_pygments()
+        highlight.check_style(self.pygments_style)
+        import hashlib
+        blocks = []  # (start, stop, key, task, cache key)
+        i = 0
+        while i < len(lines):
+            key = self.match_marker(lines[i])
+            if key is None or lines[i].strip() != self.supported[key][1]:
+                i += 1
+                continue
+            obj = self.supported[key][0]
+            if key not in self.minted:
+                minted = None
+                if obj.envir_type.startswith('Minted_'):
+                    minted = highlight.minted_environment(obj.breplace,
+                                                          obj.ereplace)
+                if minted is not None and not highlight.has_lexer(minted[1]):
+                    print >>self.out, '*** warning: Pygments has no lexer for %s, ' \
+                          'the %s environment is left to minted' % \
+                          (minted[1], key)
+                    minted = None
+                self.minted[key] = minted
+            minted = self.minted[key]
+            end = self.supported[key][2]
+            stop = i + 1
+            while stop < len(lines) and not lines[stop].startswith(end):
+                stop += 1
+            if minted is None or stop == len(lines):
+                i += 1
+                continue
+            prefix, language, verboptions, flags, suffix = minted
+            code = '\n'.join(lines[i+1:stop]) + '\n'
+            task = (code, language, self.pygments_style, verboptions, flags)
+            cache_key = (self.document,) + task[1:] + \
+                        (hashlib.sha1(code).hexdigest(),)
+            blocks.append((i, stop, key, task, cache_key))
+            i = stop + 1
+        if not blocks:
+            return lines
+
+        rendered = {}  # cache key -> highlighted code
+        pending = []   # blocks to be highlighted
+        for block in blocks:
+            cache_key = block[4]
+            if cache_key in rendered:
+                continue
+            rendered[cache_key] = self.highlight_cache.get(cache_key)
+            if rendered[cache_key] is None:
+                pending.append(block)
+        tasks = [block[3] for block in pending]
+        import multiprocessing
+        # (a pool pays off for many blocks, and batch mode processes
+        # cannot start a pool of their own)
+        if self.jobs > 1 and len(tasks) >= highlight.pool_min_blocks and \
+               not multiprocessing.current_process().daemon:
+            pool = multiprocessing.Pool(min(self.jobs, len(tasks)))
+            try:
+                results = pool.map(highlight.render, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [highlight.render(task) for task in tasks]
+        for block, result in zip(pending, results):
+            rendered[block[4]] = result
+            self.highlight_cache.set(block[4], result)
+        self.highlight_cache.save()
+        if self.verbose: print >>self.out, self.highlight_cache.summary()
+
+        output = []
+        pos = 0
+        for start, stop, key, task, cache_key in blocks:
+            obj = self.supported[key][0]
+            prefix, language, verboptions, flags, suffix = self.minted[key]
+            output.extend(lines[pos:start])
+            text = []
+            if 'pygments style' not in defined:
+                text.append(str(highlight.style_defs(self.pygments_style)))
+                defined['pygments style'] = True
+            if key not in defined:
+                if obj.define:
+                    text.append(obj.newenv)
+                defined[key] = True
+            text.append(prefix)
+            text.append(rendered[cache_key].rstrip('\n'))
+            text.append(suffix)
+            text.append(lines[stop][len(self.supported[key][2]):])
+            output.append(''.join(text))
+            pos = stop + 1
+        output.extend(lines[pos:])
+        return output
+
+    def write_intermediate(self, filename, text):
+        """Write the text passed between two stages to a temporary file."""
+        open(filename, 'w').write(text)
+
+    def run_stage(self, stage, text=None, *args):
+        """Run the stage (the name of one of the methods preprocessor,
+        inline_tt, include_file, include_command and convert) on text and
+        return the output (extra arguments are passed on to the stage).
+        The callbacks in self.on_stage_start are called as
+        f(stage, bytes_in) before the stage, and the callbacks in
+        self.on_stage_end as f(stage, bytes_in, bytes_out, wall, cpu)
+        after the stage (wall and CPU time in seconds). If text is None
+        (the preprocessor stage reading the .p.tex file), bytes_in is the
+        size of the file."""
+        if text is not None:
+            bytes_in = len(text)
+        elif os.path.isfile(self.ptexfile):
+            bytes_in = os.path.getsize(self.ptexfile)
+        else:
+            bytes_in = 0
+        for callback in self.on_stage_start:
+            callback(stage, bytes_in)
+        wall0 = time.time()
+        cpu0 = time.clock()
+        if text is None:
+            output = getattr(self, stage)()
+        else:
+            output = getattr(self, stage)(text, *args)
+        cpu = time.clock() - cpu0
+        wall = time.time() - wall0
+        for callback in self.on_stage_end:
+            callback(stage, bytes_in, len(output), wall, cpu)
+        return output
+
+    def record_timing(self, stage, bytes_in, bytes_out, wall, cpu):
+        """Callback for on_stage_end used by --timings."""
+        self.timings.append((stage, bytes_in, bytes_out, wall, cpu))
+
+    def print_timings(self):
+        """Print the timings recorded by record_timing (--timings).
+        The timings of a stage that is run several times (on each
+        chunk in streaming mode) are added."""
+        stages = []
+        totals = {}
+        for stage, bytes_in, bytes_out, wall, cpu in self.timings:
+            if stage not in totals:
+                stages.append(stage)
+                totals[stage] = [0, 0, 0, 0]
+            for i, value in enumerate((wall, cpu, bytes_in, bytes_out)):
+                totals[stage][i] += value
+        print >>self.out, '%-16s %9s %9s %10s %10s' % \
+              ('stage', 'wall (s)', 'cpu (s)', 'bytes in', 'bytes out')
+        for stage in stages:
+            print >>self.out, '%-16s %9.4f %9.4f %10d %10d' % \
+                  tuple([stage] + totals[stage])
+        print >>self.out, '%-16s %9.4f %9.4f' % \
+              ('total', sum([t[3] for t in self.timings]),
+               sum([t[4] for t in self.timings]))
+        self.timings = []
+
+    def convert_text(self, text):
+        """Run all the stages on text (the contents of a .p.tex file)
+        and return the resulting LaTeX text. No files are written."""
+        self._cleanup = True
+        text = self.run_stage('preprocessor', text)
+        text = self.run_stage('inline_tt', text)
+        text = self.run_stage('include_file', text)
+        text = self.run_stage('include_command', text)
+        return self.run_stage('convert', text)
+
+    def run(self, pretext=None):
+        """Runs through the different functions necessary to complete the
+        conversion. The text is passed from stage to stage in memory.
+        The temporary files are only written if --keep-intermediate is
+        given or if convert detects problems that should be inspected.
+        If pretext (the output of inline_tt in a previous run) is given,
+        the conversion starts with the include_file stage.
+        With --profile FILE, the conversion is run under cProfile."""
+        self.profiled(self._run, pretext)
+
+    def profiled(self, function, *args):
+        """Call function(*args), under cProfile if --profile is given."""
+        if self.profile is None:
+            return function(*args)
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args)
+        finally:
+            profiler.dump_stats(self.profile)
+            print >>self.out, 'profile written to %s' % self.profile
+
+    def _run(self, pretext=None):
+        self._cleanup = True
+        if pretext is None and self.uptodate():
+            print >>self.out, '%s is up to date' % self.texfile
+            self.changed = False
+            return
+        if pretext is None:
+            text = self.run_stage('preprocessor')
+            text = self.run_stage('inline_tt', text)
+            pretext = text
+        self.pretext = text = pretext
+        text = self.run_stage('include_file', text)
+        text = self.run_stage('include_command', text)
+        transtext = text
+        text = self.run_stage('convert', text)
+        # an unchanged .tex file is not rewritten, such that LaTeX or
+        # make do not see a new modification time:
+        self.changed = write_if_changed(self.texfile, text)
+        if self.changed:
+            print >>self.out, 'done %s -> %s' % (self.ptexfile, self.texfile)
+        else:
+            print >>self.out, 'done %s -> %s (unchanged)' % (self.ptexfile, self.texfile)
+        self.prune_caches()
+        if self.timings:
+            self.print_timings()
+        if self.keep_intermediate or not self._cleanup:
+            self.write_intermediate(self.preoutfile, pretext)
+            self.write_intermediate(self.transfile, transtext)
+        if self.dependency_cache is not None:
+            self.record_dependencies()
+        if self.write_depfile:
+            self.write_dependencies()
+
+    def chunks(self, infile, size=stream_chunk_size):
+        """Read infile line by line and yield chunks of text that can
+        be converted independently: a chunk ends with a blank line when
+        it is at least size bytes long, but never inside an environment
+        (between \\bNAME and \\eNAME) or inside a preprocessor #if block."""
+        chunk = []
+        length = 0
+        end_marker = None  # end marker of the current environment
+        depth = 0          # nesting level of preprocessor #if blocks
+        for line in iter(infile.readline, ''):
+            chunk.append(line)
+            length += len(line)
+            if end_marker is None:
+                key = self.match_marker(line)
+                if key is not None and \
+                       line.startswith(self.supported[key][1]):
+                    end_marker = self.supported[key][2]
+            elif line.startswith(end_marker):
+                end_marker = None
+            if preprocess_if_pattern.match(line):
+                depth += 1
+            elif preprocess_endif_pattern.match(line):
+                depth -= 1
+            if length >= size and end_marker is None and depth <= 0 and \
+                   not line.strip():
+                yield ''.join(chunk)
+                chunk = []
+                length = 0
+        if chunk:
+            yield ''.join(chunk)
+
+    def stream(self, infile=sys.stdin, outfile=sys.stdout):
+        """Convert the text read from infile and write the result to
+        outfile, chunk by chunk (see chunks), such that only one chunk of
+        the document is kept in memory. The output is the same as when
+        the whole text is converted at once."""
         self._cleanup = True
-        self.preprocessor()
-        self.inline_tt()
-        self.include_file()
-        self.include_command()
-        self.convert()
-        if self._cleanup:
-            self.cleanup()
+        defines = dict(self.preprocess_defines)  # preprocessor variables
+        defined = {}  # environments whose newenv is already inserted
+        first = True
+        for chunk in self.chunks(infile):
+            text = self.run_stage('preprocessor', chunk, defines)
+            text = self.run_stage('inline_tt', text)
+            text = self.run_stage('include_file', text)
+            text = self.run_stage('include_command', text)
+            text = self.run_stage('convert', text, defined)
+            # convert drops the final newline of each chunk:
+            if not first:
+                outfile.write('\n')
+            outfile.write(text)
+            outfile.flush()
+            first = False
+        self.prune_caches()
+        if self.timings:
+            self.print_timings()
+
+    def prune_caches(self):
+        """Remove the entries of this document that the run did not use
+        from the caches, and save the caches."""
+        for c in (self.snippet_cache, self.cmd_cache, self.symbol_cache,
+                  self.highlight_cache):
+            if c is not None:
+                c.prune(self.document)
+                c.save()
+
+    def dependencies(self):
+        """Return the input files of the last conversion: the .p.tex
+        file, the config files, the files included by the preprocessor
+        and by @@@CODE/@@@DATA, and the files named in @@@CMD commands."""
+        files = [self.ptexfile]
+        for filename in envs.config_files(os.path.dirname(self.ptexfile)):
+            if os.path.isfile(filename):
+                files.append(filename)
+        for filename in self.preprocess_dependencies + \
+                self.include_dependencies + self.command_dependencies:
+            if filename not in files:
+                files.append(filename)
+        return files
+
+    def settings(self):
+        """Return the command-line settings that affect the output."""
+        return (sorted(self.preprocess_defines.items()),
+                list(self.preprocess_includes), self.preprocess_substitute,
+                self.pygments and self.pygments_style, self.regex,
+                self.cmd_max_output)
+
+    def file_states(self, files):
+        """Return the (modification time, size) of each file in files
+        (None for files that do not exist)."""
+        states = []
+        for filename in files:
+            try:
+                stat = os.stat(filename)
+                states.append((filename, stat.st_mtime, stat.st_size))
+            except OSError:
+                states.append((filename, None))
+        return states
+
+    def record_dependencies(self):
+        """Store the state of the input files of the conversion in the
+        dependency cache. The config files are recorded even if they do
+        not exist, such that adding a local config file is detected."""
+        files = self.dependencies()
+        for filename in envs.config_files(os.path.dirname(self.ptexfile)):
+            if filename not in files:
+                files.append(filename)
+        self.dependency_cache.set(os.path.abspath(self.texfile),
+                                  (self.settings(), self.file_states(files)))
+        self.dependency_cache.save()
+
+    def uptodate(self):
+        """Return True if --if-changed is given, and the .tex file and
+        the settings and all the input files of the previous conversion
+        are unchanged."""
+        if self.dependency_cache is None or \
+               not os.path.isfile(self.texfile):
+            return False
+        record = self.dependency_cache.get(os.path.abspath(self.texfile))
+        if record is None:
+            return False
+        settings, states = record
+        if settings != self.settings():
+            return False
+        files = [state[0] for state in states]
+        return states == self.file_states(files)
+
+    def write_dependencies(self):
+        """Write a Makefile depfile (FILE.d) for the conversion, with a
+        rule that makes the .tex file depend on all input files."""
+        def escape(filename):
+            return filename.replace('$', '$$').replace(' ', '\\ ')
+        lines = ['%s:' % escape(self.texfile)]
+        for filename in self.dependencies():
+            lines.append(' %s' % escape(filename))
+        write_if_changed(self.depfile, ' \\\n'.join(lines) + '\n')
+
+    def watched_files(self):
+        """Return a dict with the input files of the conversion as keys
+        and the first stage that must be run again when the file changes
+        as values ('config', 'document' or 'include')."""
+        files = {}
+        for filename in self.include_dependencies + self.command_dependencies:
+            files[filename] = 'include'
+        for filename in self.preprocess_dependencies:
+            files[filename] = 'document'
+        files[self.ptexfile] = 'document'
+        for filename in envs.config_files(os.path.dirname(self.ptexfile)):
+            files[filename] = 'config'
+        return files
+
+    def watch(self, interval=0.1):
+        """Poll the input files of the conversion (the .p.tex file, the
+        config files and the files included by @@@CODE/@@@DATA or named
+        in @@@CMD commands) every interval seconds. When a file changes,
+        run the stages that depend on it again. The snippet cache is
+        kept in memory (if not stored in .ptex2tex-cache). The @@@CMD
+        commands are run again at each rebuild unless --cmd-cache is
+        given, since their output may depend on files that are not
+        named on the command line."""
+        if self.snippet_cache is None:
+            self.snippet_cache = cache.Cache(None, 'snippets')
+
+        def mtime(filename):
+            try:
+                return os.stat(filename).st_mtime
+            except OSError:
+                return None
+
+        converter = self
+        files = converter.watched_files()
+        mtimes = dict([(f, mtime(f)) for f in files])
+        print >>self.out, 'watching %d files for changes (Ctrl-C to stop)' % len(files)
+        try:
+            while True:
+                time.sleep(interval)
+                changed = [files[f] for f in files if mtime(f) != mtimes[f]]
+                if not changed:
+                    continue
+                try:
+                    # (with --lazy-envs the environments depend on the
+                    # document too)
+                    if 'config' in changed or \
+                           (self.lazy_envs and 'document' in changed):
+                        new = _Ptex2tex(self.argv)
+                        new.snippet_cache = converter.snippet_cache
+                        new.cmd_cache = converter.cmd_cache
+                        new.highlight_cache = converter.highlight_cache
+                        new.symbol_cache = converter.symbol_cache
+                        converter = new
+                        converter.run()
+                    elif 'document' in changed:
+                        converter.run()
+                    else:
+                        converter.run(pretext=converter.pretext)
+                except Ptex2texError, e:
+                    print >>self.out, e
+                    print >>self.out, '*** conversion failed, waiting for changes...'
+                files = converter.watched_files()
+                mtimes = dict([(f, mtime(f)) for f in files])
+        except KeyboardInterrupt:
+            print >>self.out
+
+def convert(text, config=None, defines=None, include_resolver=None,
+            includes=None, substitute=False, verbose=False):
+    """
+    Convert text (the contents of a .p.tex file) and return the
+    resulting LaTeX text. No files are written, and errors raise
+    Ptex2texError instead of terminating the program.
+
+    config: table of environments as returned by envs.envs(dirname)
+            (default: the config files in the current and home directory).
+            The table is not changed and can be used in many calls.
+    defines: dict of preprocessor variables and their values (added to
+            the defines in the config file).
+    include_resolver: function that takes the name of a file included
+            by @@@CODE/@@@DATA and returns its text (default: read the
+            file).
+    includes: list of directories for preprocessor include statements.
+    substitute: substitute preprocessor variables in the text.
+    verbose: print the progress messages of the command-line tool (they
+            are suppressed by default).
+    """
+    out = _Messages(quiet=not verbose)
+    if config is None:
+        config = envs.envs(os.curdir, out=out)
+    converter = _Ptex2tex(['ptex2tex', 'text'], supported=config)
+    converter.out = out
+    if defines:
+        converter.preprocess_defines.update(defines)
+    if includes:
+        converter.preprocess_includes = list(includes)
+    converter.preprocess_substitute = substitute
+    converter.include_resolver = include_resolver
+    converter.verbose = verbose
+    return converter.convert_text(text)
 
 def init(argv=sys.argv):
-    instance = _Ptex2tex(argv)
-    instance.run()
+    options, files = split_argv(argv[1:])
+    try:
+        if '-' in files:
+            if len(files) > 1:
+                raise Ptex2texError('- (standard input) cannot be combined with other files', 1)
+            # messages go to standard error, the result to standard output:
+            stdout = sys.stdout
+            sys.stdout = sys.stderr
+            instance = _Ptex2tex(argv)
+            instance.profiled(instance.stream, sys.stdin, stdout)
+            return
+        if len(files) > 1:
+            sys.exit(batch(options, files))
+        instance = _Ptex2tex(argv)
+        if '--watch' in argv:
+            try:
+                instance.run()
+            except Ptex2texError, e:
+                print e
+                print '*** conversion failed, waiting for changes...'
+            instance.watch()
+        else:
+            instance.run()
+    except Ptex2texError, e:
+        print e
+        sys.exit(e.status)
+
+# environment tables (one per directory) in the batch pool processes:
+_batch_tables = {}
+
+def _batch_init(tables):
+    _batch_tables.update(tables)
+
+def _batch_convert(argv):
+    """Convert the file argv[-1] in a batch pool process.
+    Return the exit status of the conversion."""
+    import traceback
+    supported = _batch_tables[os.path.dirname(argv[-1])]
+    try:
+        _Ptex2tex(argv, supported=supported).run()
+    except Ptex2texError, e:
+        print e
+        return e.status
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+def batch(options, files):
+    """Convert several files on a pool of -j N processes. The config
+    files are read once for each directory. The @@@CMD commands of a
+    file are run on the remaining -j capacity. Return 0 if all files were
+    converted successfully, otherwise the largest exit status."""
+    import multiprocessing
+    n = jobs(options)
+    processes = max(1, min(n, len(files)))
+    # strip -j N and --profile FILE from the options passed on to each
+    # conversion:
+    profile = option_value(options, '--profile')
+    file_options = []
+    i = 0
+    while i < len(options):
+        if options[i] in ('-j', '--profile'):
+            i += 2
+            continue
+        file_options.append(options[i])
+        i += 1
+    file_options += ['-j', str(max(1, n//processes))]
+
+    tables = {}
+    for filename in files:
+        dirname = os.path.dirname(filename)
+        if dirname not in tables:
+            tables[dirname] = envs.envs(dirname, cache='--cache' in options)
+    tasks = [['ptex2tex'] + file_options + [filename] for filename in files]
+    if profile is not None:
+        # one profile per file: FILE.basename
+        for task in tasks:
+            basename = os.path.basename(task[-1])
+            if basename.endswith('.p.tex'):
+                basename = basename[:-6]
+            task[-1:-1] = ['--profile', '%s.%s' % (profile, basename)]
+    pool = multiprocessing.Pool(processes, _batch_init, (tables,))
+    try:
+        statuses = pool.map(_batch_convert, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+    failed = [filename for filename, status in zip(files, statuses) if status]
+    if failed:
+        print '*** conversion failed for %s' % ', '.join(failed)
+    return max(statuses)
 
 __doc__ = doc()
@@ -0,0 +1,122 @@
+"""
+Persistent caches for ptex2tex, stored in the directory .ptex2tex-cache
+next to the .p.tex file. Each cache is a dict that is pickled to a file
+in this directory, such that results from one run can be reused in the
+next run. The keys start with the name of the document, and the entries
+of a document that a run did not use are removed (see Cache.prune), so
+the caches do not grow each time an input file changes.
+
+Several ptex2tex processes (e.g. batch mode with -j) may use the same
+cache file. A process only writes the entries it stored or removed
+itself: Cache.save locks the file, reads the entries written by other
+processes since, applies the changes of this process and writes the
+result.
+"""
+
+import os
+import cPickle as pickle
+
+cache_dirname = '.ptex2tex-cache'
+
+class Cache:
+    """A dict stored in the file NAME.pickle in the cache directory
+    (NAME may contain a subdirectory).
+    Lookups are counted such that a hit/miss summary can be reported.
+    If dirname is None, the cache is only kept in memory."""
+    def __init__(self, dirname, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.modified = False
+        self.used = set()  # keys looked up or stored since the last prune
+        self.stored = set()   # keys stored since the last save
+        self.removed = set()  # keys removed since the last save
+        if dirname is None:
+            self.dirname = self.filename = None
+            self.data = {}
+            return
+        self.dirname = os.path.join(dirname, cache_dirname)
+        self.filename = os.path.join(self.dirname, name + '.pickle')
+        try:
+            self.data = pickle.load(open(self.filename, 'rb'))
+        except Exception:
+            # missing or corrupt cache file, start with an empty cache
+            self.data = {}
+
+    def get(self, key):
+        """Return the value stored for key (None if not in the cache)."""
+        if key in self.data:
+            self.hits += 1
+            self.used.add(key)
+            return self.data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.used.add(key)
+        self.stored.add(key)
+        self.removed.discard(key)
+        self.modified = True
+
+    def delete(self, key):
+        del self.data[key]
+        self.removed.add(key)
+        self.stored.discard(key)
+        self.modified = True
+
+    def prune(self, group):
+        """Remove the entries whose key starts with group (the document)
+        that were not looked up or stored since the last prune."""
+        for key in self.data.keys():
+            if key[0] == group and key not in self.used:
+                self.delete(key)
+        self.used = set()
+
+    def save(self):
+        """Write the cache to file (if it was modified), merged with the
+        entries other processes have written to the file. The file is
+        written to a temporary file first and then renamed, such that
+        other ptex2tex processes never see a partially written cache."""
+        if not self.modified or self.filename is None:
+            self.stored.clear()
+            self.removed.clear()
+            return
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):  # not created by others
+                    raise
+        lock = open(self.filename + '.lock', 'a')
+        try:
+            try:
+                import fcntl
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            except ImportError:
+                pass  # no locking (Windows)
+            try:
+                data = pickle.load(open(self.filename, 'rb'))
+            except Exception:
+                data = {}
+            for key in self.removed:
+                data.pop(key, None)
+            for key in self.stored:
+                data[key] = self.data[key]
+            import tempfile
+            fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmpname, self.filename)
+        finally:
+            lock.close()  # (releases the lock)
+        self.data = data
+        self.stored.clear()
+        self.removed.clear()
+        self.modified = False
+
+    def summary(self):
+        return '%s cache: %d hits, %d misses' % \
+               (self.name, self.hits, self.misses)
@@ -0,0 +1,178 @@
+"""
+Built-in preprocessor for the preprocessor statements in .p.tex files.
+The statements are LaTeX comment lines of the form
+
+% #define VAR [VALUE]
+% #undef VAR
+% #ifdef VAR
+% #ifndef VAR
+% #if EXPRESSION
+% #elif EXPRESSION
+% #else
+% #endif
+% #include "FILE"
+% #error MESSAGE
+
+as in Trent Mick's preprocess module. EXPRESSION is a Python expression
+where the defined variables can be used, and defined('VAR') (with the
+name as a string) tests if VAR is defined. The statement lines are removed from the text, and so are
+the lines in #if blocks whose condition is false. With substitute=True,
+the names of the defined variables are replaced by their values in the
+rest of the text.
+
+The text is scanned for statements with one regular expression, the
+text between the statements is copied in one piece, and each
+EXPRESSION is compiled only once.
+"""
+
+import os, re
+from ptex2tex.errors import Ptex2texError
+
+statement_pattern = re.compile(
+    r'^[ \t]*%[ \t]*#[ \t]*(define|undef|ifdef|ifndef|if|elif|else|endif|'
+    r'include|error)\b[ \t]*(.*?)[ \t\r]*$\n?', re.MULTILINE)
+
+# compiled #if/#elif expressions:
+_expressions = {}
+
+def value(text):
+    """Return the Python value of the string text (e.g. 1 or "title"),
+    or text itself if it is not a Python literal."""
+    if not isinstance(text, basestring):
+        return text
+    import ast
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+class Preprocessor:
+    """Preprocessor with the variables in the dict defines (updated by
+    #define and #undef statements) and the list of directories includes
+    for #include statements. The files read by #include statements are
+    added to the list self.included."""
+    def __init__(self, defines=None, includes=(), substitute=False):
+        if defines is None:
+            defines = {}
+        for name in defines:
+            defines[name] = value(defines[name])
+        self.defines = defines
+        self.includes = list(includes)
+        self.substitute = substitute
+        self.included = []
+        self._substitution = None  # regex matching the defined names
+
+    def process(self, text, filename=None):
+        """Return the preprocessed text. filename is the name of the file
+        the text is read from, used for error messages and for finding
+        the files in #include statements (which are otherwise looked up
+        in the current directory and the include directories)."""
+        output = []
+        stack = []     # (parent active, branch taken, #else seen) for
+                       # each open #if
+        active = True  # are the lines at this position kept?
+        pos = 0
+        for m in statement_pattern.finditer(text):
+            if active:
+                output.append(self.substituted(text[pos:m.start()]))
+            pos = m.end()
+            statement, argument = m.groups()
+            if statement in ('if', 'ifdef', 'ifndef'):
+                # conditions in inactive blocks are not evaluated:
+                taken = active and self.condition(statement, argument,
+                                                  text, m, filename)
+                stack.append((active, taken, False))
+                active = taken
+            elif statement in ('elif', 'else', 'endif'):
+                if not stack:
+                    self.error('#%s without #if' % statement,
+                               text, m, filename)
+                parent, taken, else_seen = stack[-1]
+                if statement != 'endif' and else_seen:
+                    self.error('#%s after #else' % statement,
+                               text, m, filename)
+                if statement == 'endif':
+                    stack.pop()
+                    active = parent
+                elif statement == 'else':
+                    active = parent and not taken
+                    stack[-1] = (parent, True, True)
+                else:
+                    active = parent and not taken and \
+                             self.condition('if', argument, text, m, filename)
+                    stack[-1] = (parent, taken or active, False)
+            elif not active:
+                continue
+            elif statement == 'define':
+                words = argument.split(None, 1)
+                if not words:
+                    self.error('#define without variable', text, m, filename)
+                self.defines[words[0]] = \
+                    value(words[1]) if len(words) > 1 else True
+                self._substitution = None
+            elif statement == 'undef':
+                self.defines.pop(argument.strip(), None)
+                self._substitution = None
+            elif statement == 'include':
+                output.append(self.include(argument, text, m, filename))
+            elif statement == 'error':
+                self.error('#error %s' % argument, text, m, filename)
+        if stack:
+            self.error('missing #endif', text, None, filename)
+        if active:
+            output.append(self.substituted(text[pos:]))
+        return ''.join(output)
+
+    def condition(self, statement, argument, text, m, filename):
+        """Return the truth value of an #if, #ifdef or #ifndef test."""
+        if statement == 'ifdef':
+            return argument.strip() in self.defines
+        if statement == 'ifndef':
+            return argument.strip() not in self.defines
+        if argument not in _expressions:
+            try:
+                _expressions[argument] = compile(argument, '<#if>', 'eval')
+            except SyntaxError:
+                self.error('invalid expression in #if %s' % argument,
+                           text, m, filename)
+        namespace = {'defined': lambda name: name in self.defines}
+        try:
+            return bool(eval(_expressions[argument], namespace, self.defines))
+        except Exception, e:
+            self.error('could not evaluate #if %s (%s)' % (argument, e),
+                       text, m, filename)
+
+    def include(self, argument, text, m, filename):
+        """Return the preprocessed text of the file in an #include
+        statement."""
+        name = argument.strip().strip('"\'')
+        directory = os.path.dirname(filename) if filename else os.curdir
+        for directory in [directory] + self.includes:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                self.included.append(path)
+                return self.process(open(path).read(), path)
+        self.error('could not find #include file %s' % name,
+                   text, m, filename)
+
+    def substituted(self, text):
+        """Return text with the defined names replaced by their values
+        (if substitute is true)."""
+        if not self.substitute or not self.defines or not text:
+            return text
+        if self._substitution is None:
+            # the longest names are tried first:
+            names = sorted(self.defines, key=len, reverse=True)
+            self._substitution = re.compile(
+                '|'.join([re.escape(name) for name in names]))
+        return self._substitution.sub(
+            lambda m: str(self.defines[m.group()]), text)
+
+    def error(self, message, text, m, filename):
+        if m is None:
+            where = filename or 'text'
+        else:
+            where = '%s, line %d' % (filename or 'text',
+                                     text.count('\n', 0, m.start()) + 1)
+        raise Ptex2texError('preprocessor error in %s: %s' %
+                            (where, message), 1)
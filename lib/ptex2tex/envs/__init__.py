@@ -1,13 +1,14 @@
-import glob, os, sys, re, shutil
-import ConfigParser
+import os, sys, re
+from ptex2tex.cache import Cache
+from ptex2tex.errors import Ptex2texError
 
 def doc():
     return """
 Short description of use for envs/__init__.py, part of the ptex2tex package
 ==================================================================
 
-New environments are added by creating an instance of
-class Env and replacing the attributes.
+New environments are added in the config files. Each environment
+is an Env record created from the options of its environment type.
 
 The following variables are inharited:
 self.fontsize
@@ -30,7 +31,7 @@ The commandline arguments result in the following strings:
 #            normal = 0.85
 # margin is not used for the time being
 
-The functions breplace(self) and ereplace(self) return the
+The attributes breplace and ereplace contain the
 LaTeX code we want to replace the keywords with.
 
 If the file '.ptex2tex' exists in the directory where the .p.tex file
@@ -41,9 +42,24 @@ If the file does not exist, it is copied.
 
 __doc__ = doc()
 
+# version of the environment table stored by envs(dirname, cache=True),
+# to be increased when the Env records change:
+table_version = 3
+
+# environments used by the @@@CODE, @@@DATA and @@@CMD statements:
+builtin_names = ('pro', 'sni', 'dat', 'dsni', 'sys')
+
+# words following \b and \e at the beginning of a line (possible
+# begin and end markers of environments):
+marker_token_pattern = re.compile(r'^[ \t]*\\[be](\S+)', re.MULTILINE)
+
 class Env(object):
-    """Class for the different environments. All environments are instances
-    of this class with the attributes replaced."""
+    """Record for the different environments, created from the options
+    in the environment type section of the config file. The values are
+    interpolated by ConfigParser when the config file is read, and the
+    records cannot be changed, so the same table of environments can be
+    used by many conversions. Options without special meaning (like
+    fontsize) are available as attributes too."""
     # fontsize :
     #            tiny   = fontsize{7pt}{7pt}\selectfont
     #            small  = fontsize{9pt}{9pt}\selectfont
@@ -55,30 +71,54 @@ class Env(object):
     # define   :
     #            True   = Define environment once every file
     #            False  = Assumes environment defined externally
-    def __init__(self):
-        """Sets default values for attributes."""
-        self.fontsize = "footnotesize"
-        self.bstretch = "0.85"
-        self.name = ""
-	self.env = r'{Verbatim}'
-        self.newenv = ""
-        self.breplace = ""
-        self.ereplace = ""
-        self.define = True
-        self.envir_type = ""
+    __slots__ = ('name', 'envir_type', 'newenv', 'breplace', 'ereplace',
+                 'define', 'first_breplace', '_options')
+    defaults = {'fontsize': 'footnotesize', 'bstretch': '0.85',
+                'env': r'{Verbatim}', 'newenv': '', 'breplace': '',
+                'ereplace': '', 'define': True}
+
+    def __init__(self, name, envir_type, options=None):
+        """Set the attributes from the dict options (missing options
+        get the values in Env.defaults)."""
+        values = self.defaults.copy()
+        if options:
+            values.update(options)
+        set = object.__setattr__
+        set(self, 'name', name)
+        set(self, 'envir_type', envir_type)
+        for attr in 'newenv', 'breplace', 'ereplace', 'define':
+            set(self, attr, values[attr])
+        # replacement of the begin marker where the environment is used
+        # for the first time in a document (newenv is inserted if the
+        # environment is to be defined in the document):
+        if self.define:
+            set(self, 'first_breplace', self.newenv + self.breplace)
+        else:
+            set(self, 'first_breplace', self.breplace)
+        set(self, '_options', values)
+
+    def __getattr__(self, attr):
+        try:
+            return self._options[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('environment %s cannot be changed' % self.name)
+
+    def __reduce__(self):
+        return (Env, (self.name, self.envir_type, self._options))
 
     def __str__(self):
         s = ''
-        #for attr in self.__dict__:
-        #    s += '\n%s:\n%s\n' % (attr, self.__dict__[attr])
         s += '\nname: %s\n' % self.name
         s += '\n    newenv: %s\n' % self.newenv
         return s
 
     def __repr__(self):
         return self.__str__()
-        
-def envs(dirname):
+
+def envs(dirname, cache=False, tokens=None, out=None):
     """Function for finding all valid environments, defined in the users
     home directory (.ptex2tex.cfg). If this file doesn't exist, it is copied
     there when ptex2tex is invoked. If a local .ptex2tex.cfg exists 
@@ -86,19 +126,95 @@ def envs(dirname):
     added. Existing options will be overridden. Returns a dict where the keys are the
     codes for the classes, and the values are a tuple consisting of an instance
     of the class, as well as the begin and end codes. All files follow the
-    ConfigParser (.cfg) style."""
+    ConfigParser (.cfg) style.
 
-    cfgfile = os.path.join(os.path.join(dirname, '.ptex2tex.cfg'))
+    If cache is true, the resulting dict is stored in the directory
+    .ptex2tex-cache, and later calls return the stored dict as long as
+    the config files are unchanged.
+
+    If tokens is given (a list of the words after \\b and \\e at the
+    beginning of the lines in a document, see marker_tokens), only the
+    environments with these markers are created (see used_names).
+
+    The messages are written to the file-like object out (default:
+    sys.stdout)."""
+
+    if out is None:
+        out = sys.stdout
+    homecfgfile, cfgfile = cfgfiles = config_files(dirname)
     if os.path.isfile(cfgfile):
-        print 'using local config file .ptex2tex.cfg'
+        print >>out, 'using local config file .ptex2tex.cfg'
 
-    homecfgfile = os.path.join(os.path.expanduser('~'), '.ptex2tex.cfg')
     if not os.path.isfile(homecfgfile):
-        print 'copying .ptex2tex.cfg to %s' %(os.path.expanduser('~'))
+        print >>out, 'copying .ptex2tex.cfg to %s' %(os.path.expanduser('~'))
+        import shutil
         shutil.copy(os.path.join(os.path.dirname(__file__), os.pardir, 'ptex2tex.cfg'),
                     homecfgfile)
     
-    cfgfiles = [homecfgfile, cfgfile]
+    if cache:
+        config_cache = Cache(dirname, 'config')
+        cfgkey = config_key(cfgfiles)
+        if tokens is None:
+            key = (cfgkey, None)
+        else:
+            key = (cfgkey, tuple(sorted(set(tokens))))
+        supported = config_cache.get(key)
+        if supported is not None:
+            return supported
+    supported = read_config(cfgfiles, tokens)
+    if cache:
+        # only the tables for the current config files are kept:
+        for old in config_cache.data.keys():
+            if old[0] != cfgkey:
+                config_cache.delete(old)
+        config_cache.set(key, supported)
+        config_cache.save()
+    return supported
+
+def marker_tokens(text):
+    """Return the words after \\b and \\e at the beginning of the lines
+    in text."""
+    return marker_token_pattern.findall(text)
+
+def used_names(tokens, names):
+    """Return the environment names in the list names whose markers
+    (\\bNAME or \\eNAME) can match a line starting with \\b or \\e and
+    one of the tokens, i.e., the names that are prefixes of a token."""
+    names = set(names)
+    used = set()
+    for token in set(tokens):
+        for length in range(1, len(token)+1):
+            if token[:length] in names:
+                used.add(token[:length])
+    return used
+
+def config_files(dirname):
+    """Return the names of the home and the local config file (the
+    files do not need to exist)."""
+    return [os.path.join(os.path.expanduser('~'), '.ptex2tex.cfg'),
+            os.path.join(dirname, '.ptex2tex.cfg')]
+
+def config_key(cfgfiles):
+    """Return a key identifying the contents of the config files: the
+    path, modification time, size and hash of each file (and the
+    version of the Env records)."""
+    import hashlib
+    key = [table_version]
+    for cfgfile in cfgfiles:
+        if os.path.isfile(cfgfile):
+            stat = os.stat(cfgfile)
+            key.append((os.path.abspath(cfgfile), stat.st_mtime, stat.st_size,
+                        hashlib.sha1(open(cfgfile, 'rb').read()).hexdigest()))
+        else:
+            key.append((os.path.abspath(cfgfile), None))
+    return tuple(key)
+
+def read_config(cfgfiles, tokens=None):
+    """Parse the config files and return the dict of environments
+    described in envs. If tokens is given, only the environments used
+    by the tokens (see envs) and by the @@@CODE/@@@DATA/@@@CMD
+    statements are created and checked."""
+    import ConfigParser
     config = ConfigParser.SafeConfigParser()
     config.read(cfgfiles)
     supported0 = {}
@@ -106,8 +222,7 @@ def envs(dirname):
     sections = config.sections()
 
     if not 'inline_code' in sections:
-        print "section 'inline_code' not found in config file"
-        sys.exit(8)
+        raise Ptex2texError("section 'inline_code' not found in config file", 8)
     supported0['inline_code'] = {}
     for option in config.options('inline_code'):
         supported0['inline_code'][option] = config.get('inline_code', option)
@@ -118,8 +233,7 @@ def envs(dirname):
 
     # Find all entries in names section:
     if not 'names' in sections:
-        print "section 'names' not found in config file"
-        sys.exit(6)
+        raise Ptex2texError("section 'names' not found in config file", 6)
         
     names = sections.pop(sections.index('names'))
 
@@ -128,26 +242,32 @@ def envs(dirname):
     # supported0[envir_name] dict with an Env object with the
     # attributes containing the information in the environment type.
     
-    for envir_name in config.options(names):
-        key = envir_name
+    configured = config.options(names)
+    if tokens is None:
+        selected = configured
+    else:
+        selected = used_names(list(tokens) + list(builtin_names), configured)
+    selected = list(selected)
+    for envir_name in selected:
         envir_type = config.get(names, envir_name)
-        supported0[envir_name] = Env()
-        supported0[envir_name].name = envir_name
-        supported0[envir_name].envir_type = envir_type
         if not envir_type in sections:
-            print "the environment type '%s' is not defined in the configuration file" % (envir_type)
-            sys.exit(7)
+            raise Ptex2texError("the environment type '%s' is not defined in the configuration file" % (envir_type), 7)
+        # user defined variables in the config file are allowed (and
+        # encouraged), so all options are stored:
+        options = {}
         for option in config.options(envir_type):
-            curdict = supported0[envir_name].__dict__
-            # Disable warninga, we should encourage the use of user defined
-            # variables in config file:
-            #if not hasattr(supported0[envir_name], option):
-            #    print "***warning: unknown option '%s' in environment '%s' " % \
-            #          (option, envir_type)
             if option == 'define':
-                curdict.update({option: config.getboolean(envir_type, option)})
+                options[option] = config.getboolean(envir_type, option)
             else:
-                curdict.update({option: config.get(envir_type, option)})
+                options[option] = config.get(envir_type, option)
+        supported0[envir_name] = Env(envir_name, envir_type, options)
+        if tokens is not None:
+            # markers in the replacement text are converted too:
+            env = supported0[envir_name]
+            text = '\n'.join([env.newenv, env.breplace, env.ereplace])
+            for name in used_names(marker_tokens(text), configured):
+                if name not in selected:
+                    selected.append(name)
 
     supported = {}
     for key in supported0:
@@ -162,8 +282,7 @@ def envs(dirname):
                               '\\' + 'b' + envir_name,
                               '\\' + 'e' + envir_name)
         except:
-            print "error in environment " + key
-            sys.exit(4)
+            raise Ptex2texError("error in environment " + key, 4)
 
     # check that newenvironment names are different:
     newenvir_names = []
@@ -192,12 +311,11 @@ def envs(dirname):
                         other_envir_type = newenvir_types[newenvir_names.index(name)]
                         #xoprint 'Found %s in [%s] too' % (name, other_envir_type)
                         if other_envir_type != envir_type:
-                            print """
+                            raise Ptex2texError("""
     Error: new latex environment "%s" defined in [%s] in
     configuration file, but this environment is alread defined in [%s].
     Construct another name for "%s" in [%s].""" % \
-                            (name, envir_type, other_envir_type, name, envir_type)
-                            sys.exit(8)
+                            (name, envir_type, other_envir_type, name, envir_type), 8)
                     else:
                         newenvir_names.append(name)
                         newenvir_types.append(supported[key][0].envir_type)
@@ -0,0 +1,8 @@
+"""Exceptions raised by ptex2tex."""
+
+class Ptex2texError(Exception):
+    """Error in the conversion of a document. The message is printed by
+    the ptex2tex script, which exits with status as exit status."""
+    def __init__(self, message, status=1):
+        Exception.__init__(self, message)
+        self.status = status
@@ -0,0 +1,112 @@
+"""
+Highlighting of the code in Minted_* environments with Pygments
+(--pygments option). The blocks are typeset in the Verbatim environment
+with the \\PY commands of the Pygments LaTeX formatter, which is what the
+minted package produces by running pygmentize with -shell-escape. The
+options of the minted environment in the config file are passed on to
+Verbatim, and LaTeX only needs the fancyvrb and color packages.
+"""
+
+import re
+from ptex2tex.errors import Ptex2texError
+
+minted_begin_pattern = re.compile(
+    r'\\begin\{minted\}(?:\[(.*?)\])?\{(.+?)\}', re.DOTALL)
+minted_end = r'\end{minted}'
+
+# minted options with a Pygments formatter option instead of a
+# Verbatim option (None: no Pygments counterpart, the option is dropped):
+formatter_options = {'mathescape': 'mathescape', 'texcl': 'texcomments',
+                     'texcomments': 'texcomments', 'linenos': 'linenos',
+                     'encoding': None, 'style': None, 'bgcolor': None}
+
+# minimum number of blocks to be highlighted on a process pool:
+pool_min_blocks = 20
+
+def import_pygments():
+    try:
+        import pygments
+    except ImportError:
+        raise Ptex2texError('--pygments requires the pygments package', 1)
+
+def check_style(style):
+    """Raise Ptex2texError if Pygments does not have the style."""
+    from pygments.styles import get_style_by_name
+    from pygments.util import ClassNotFound
+    try:
+        get_style_by_name(style)
+    except ClassNotFound:
+        raise Ptex2texError('unknown Pygments style %s' % style, 1)
+
+def split_options(options):
+    """Split the comma-separated minted options (commas inside {} do not
+    count) and return a list of the options."""
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(options):
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(options[start:i].strip())
+            start = i + 1
+    parts.append(options[start:].strip())
+    return [part for part in parts if part]
+
+def minted_environment(breplace, ereplace):
+    """Return (prefix, language, verboptions, flags, suffix) for the
+    minted environment in breplace and ereplace: the text before
+    \\begin{minted}, the language, the Verbatim options, a tuple of the
+    formatter options as (name, value) pairs, and the text after
+    \\end{minted}. Return None if the environment is not a plain minted
+    environment."""
+    m = minted_begin_pattern.search(breplace)
+    if m is None or breplace[m.end():].strip() or \
+           ereplace.find(minted_end) < 0 or \
+           ereplace[:ereplace.find(minted_end)].strip():
+        return None
+    verboptions = []
+    flags = []
+    for option in split_options(m.group(1) or ''):
+        name, value = (option.split('=', 1) + ['true'])[:2]
+        name = name.strip()
+        if name in formatter_options:
+            if formatter_options[name] is not None:
+                flags.append((formatter_options[name],
+                              value.strip().lower() == 'true'))
+        else:
+            verboptions.append(option)
+    suffix = ereplace[ereplace.find(minted_end) + len(minted_end):]
+    return (breplace[:m.start()], m.group(2).strip(), ','.join(verboptions),
+            tuple(flags), suffix)
+
+def has_lexer(language):
+    """Return True if Pygments has a lexer for language."""
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    try:
+        get_lexer_by_name(language)
+    except ClassNotFound:
+        return False
+    return True
+
+def render(task):
+    """Return the LaTeX code for the code highlighted by Pygments.
+    task is a tuple (code, language, style, verboptions, flags) (one
+    argument, such that render can be used on a process pool)."""
+    from pygments import highlight
+    from pygments.lexers import get_lexer_by_name
+    from pygments.formatters import LatexFormatter
+    code, language, style, verboptions, flags = task
+    options = dict(flags)
+    formatter = LatexFormatter(style=style, verboptions=verboptions,
+                               encoding='utf-8', **options)
+    lexer = get_lexer_by_name(language, encoding='utf-8')
+    return highlight(code, lexer, formatter)
+
+def style_defs(style):
+    """Return the LaTeX definitions of the \\PY commands for style."""
+    from pygments.formatters import LatexFormatter
+    return LatexFormatter(style=style).get_style_defs()
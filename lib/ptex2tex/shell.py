@@ -0,0 +1,73 @@
+"""
+Running the shell commands in @@@CMD statements. The output of a command
+(stdout and stderr) is written to a spool file instead of a pipe, so a
+command with a lot of output does not fill up the memory of ptex2tex.
+A command is killed (with the processes it started) when it runs longer
+than its timeout or writes more than max_output bytes; in the latter
+case the output is truncated and a marker line is added.
+"""
+
+import os, subprocess, tempfile, time
+
+truncation_marker = '[... output truncated after %d bytes ...]'
+
+def kill(process):
+    """Kill the process and its process group (the commands started
+    by the shell), if possible."""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, 9)
+        else:
+            process.kill()
+    except OSError:
+        pass  # the process has already exited
+
+def run(command, timeout=None, max_output=None):
+    """Run command in a shell and return (status, output, timed_out),
+    where status and output are as for commands.getstatusoutput (the
+    output without its last newline). The command is killed after
+    timeout seconds (if not None), and the output is cut after
+    max_output bytes (if not None)."""
+    spool = tempfile.TemporaryFile(prefix='ptex2tex-cmd-')
+    try:
+        options = {}
+        if hasattr(os, 'setsid'):
+            options['preexec_fn'] = os.setsid  # own process group
+        devnull = open(os.devnull)
+        process = subprocess.Popen(command, shell=True, stdin=devnull,
+                                   stdout=spool, stderr=subprocess.STDOUT,
+                                   close_fds=True, **options)
+        devnull.close()
+        start = time.time()
+        delay = 0.001
+        timed_out = capped = False
+        while process.poll() is None:
+            time.sleep(delay)
+            delay = min(2*delay, 0.05)
+            if timeout is not None and time.time() - start > timeout:
+                timed_out = True
+            elif max_output is not None and \
+                     os.fstat(spool.fileno()).st_size > max_output:
+                capped = True
+            else:
+                continue
+            kill(process)
+            process.wait()
+            break
+        spool.seek(0)
+        truncated = False
+        if max_output is None:
+            output = spool.read()
+        else:
+            output = spool.read(max_output)
+            truncated = spool.read(1) != ''
+        if output.endswith('\n'):
+            output = output[:-1]
+        if truncated:
+            output += '\n' + truncation_marker % max_output
+        status = process.returncode
+        if capped:
+            status = 0  # killed by ptex2tex, the output is still used
+        return status, output, timed_out
+    finally:
+        spool.close()
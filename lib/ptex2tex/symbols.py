@@ -0,0 +1,94 @@
+"""
+Index of the functions, classes and methods in a Python file, used by
+@@@CODE file.py symbol:NAME includes. The index maps the qualified name
+of each def and class statement (e.g. MyClass.method) to its span of
+lines, found with the tokenize module: the span starts at the first
+decorator (or the def/class line) and ends at the last line of the
+indented block, such that multi-line strings and bracketed expressions
+at the end of the block are included.
+
+The index only depends on the text of the file, so it is stored in the
+symbols cache under the hash of the text, and several symbol includes
+from the same file cost one tokenization.
+"""
+
+import tokenize
+from cStringIO import StringIO
+from ptex2tex.errors import Ptex2texError
+
+# tokens that do not end the block of a def/class statement:
+_blank = (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT,
+          tokenize.NEWLINE, tokenize.ENDMARKER)
+
+def text_hash(text):
+    import hashlib
+    return hashlib.sha1(text).hexdigest()
+
+def index(text, filename='text'):
+    """Return a dict mapping the qualified names of the def and class
+    statements in the Python code text to (first line, last line),
+    counted from 1."""
+    try:
+        tokens = list(tokenize.generate_tokens(StringIO(text).readline))
+    except (tokenize.TokenError, IndentationError), e:
+        raise Ptex2texError('could not index the symbols in %s: %s' %
+                            (filename, e), 1)
+    # the DEDENT closing each INDENT:
+    dedent = {}
+    stack = []
+    for i, token in enumerate(tokens):
+        if token[0] == tokenize.INDENT:
+            stack.append(i)
+        elif token[0] == tokenize.DEDENT:
+            dedent[stack.pop()] = i
+
+    symbols = {}
+    scopes = []         # (name, index of the closing DEDENT) of open blocks
+    line_start = True   # is the token the first of a logical line?
+    decorator = None    # line of the first decorator of the next def/class
+    for i, token in enumerate(tokens):
+        kind, string, (row, col) = token[:3]
+        if kind in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT,
+                    tokenize.DEDENT):
+            continue
+        if kind == tokenize.NEWLINE:
+            line_start = True
+            continue
+        first, line_start = line_start, False
+        if not first:
+            continue
+        while scopes and scopes[-1][1] < i:
+            scopes.pop()
+        if string == '@' and kind == tokenize.OP:
+            if decorator is None:
+                decorator = row
+            continue
+        if string not in ('def', 'class') or kind != tokenize.NAME:
+            decorator = None
+            continue
+        name = tokens[i+1][1]
+        start = row if decorator is None else decorator
+        decorator = None
+        # the block is the indented suite after the header line, or the
+        # rest of the header line (def f(): return 0):
+        j = i
+        while tokens[j][0] != tokenize.NEWLINE:
+            j += 1
+        k = j + 1
+        while tokens[k][0] in (tokenize.NL, tokenize.COMMENT):
+            k += 1
+        if tokens[k][0] == tokenize.INDENT:
+            end = dedent[k]
+            last = end - 1
+            while tokens[last][0] in _blank:
+                last -= 1
+            stop = tokens[last][3][0]
+        else:
+            end = j
+            stop = tokens[j][2][0]
+        qualified = '.'.join([scope[0] for scope in scopes] + [name])
+        # the first definition of a name counts (as with text search):
+        if qualified not in symbols:
+            symbols[qualified] = (start, stop)
+        scopes.append((name, end))
+    return symbols